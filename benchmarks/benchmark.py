@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+'''
+Time the stages of building and installing an environment on the fixture
+packages and on generated sets of wheels, and write the results as JSON.
+
+    $ python benchmarks/benchmark.py --output results.json
+'''
+from __future__ import absolute_import
+
+import argparse
+import base64
+import binascii
+import hashlib
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+import terrarium
+
+FIXTURES_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'tests',
+    'fixtures',
+)
+
+# Dependencies come first, since pip does not look for them in the other
+# requirements
+FIXTURES = ['test_requirement', 'foo_requirement']
+
+# size: bytes of data added to each generated wheel
+WHEEL_SIZES = {
+    'small': 0,
+    'large': 512 * 1024,
+}
+
+WHEEL_COUNTS = [10, 100, 1000]
+
+STAGES = [
+    'create_environment',
+    'create_tar_archive',
+    'gzip_compress',
+    'extract_tar_archive',
+    'create_virtualenv',
+    'pip_install_wheels',
+    'install_wheels',
+]
+
+WHEEL_TEMPLATE = '''\
+Wheel-Version: 1.0
+Generator: terrarium-benchmark
+Root-Is-Purelib: true
+Tag: py2-none-any
+'''
+
+METADATA_TEMPLATE = '''\
+Metadata-Version: 2.1
+Name: {name}
+Version: {version}
+Summary: Generated benchmark package
+'''
+
+MODULE_TEMPLATE = '''\
+def function_{index}(value):
+    return value * {index}
+'''
+
+
+def record_hash(data):
+    digest = base64.urlsafe_b64encode(hashlib.sha256(data).digest())
+    return 'sha256={}'.format(digest.rstrip('='))
+
+
+def write_wheel(wheel_dir, name, version, data_size, rng):
+    '''
+    Write a pure python wheel for name, with a module and data_size bytes of
+    data, half of it random so that it compresses like real packages do
+    '''
+    dist_info = '{}-{}.dist-info'.format(name, version)
+    module = ''.join(MODULE_TEMPLATE.format(index=i) for i in range(20))
+    random_size = data_size // 2
+    data = b''
+    if random_size:
+        data = binascii.unhexlify('{:0{}x}'.format(
+            rng.getrandbits(random_size * 8),
+            random_size * 2,
+        ))
+    data += module * ((data_size - random_size) // len(module) + 1)
+    files = [
+        ('{}/__init__.py'.format(name), module),
+        ('{}/{}'.format(dist_info, 'METADATA'), METADATA_TEMPLATE.format(
+            name=name,
+            version=version,
+        )),
+        ('{}/{}'.format(dist_info, 'WHEEL'), WHEEL_TEMPLATE),
+    ]
+    if data_size:
+        files.append(('{}/data.bin'.format(name), data[:data_size]))
+    record = ''.join(
+        '{},{},{}\n'.format(path, record_hash(content), len(content))
+        for path, content in files
+    )
+    files.append(('{}/RECORD'.format(dist_info), record + '{}/RECORD,,\n'.format(
+        dist_info,
+    )))
+
+    path = os.path.join(wheel_dir, '{}-{}-py2-none-any.whl'.format(name, version))
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as wheel:
+        for arcname, content in files:
+            wheel.writestr(arcname, content)
+    return path
+
+
+def generate_wheel_set(wheel_dir, count, size):
+    '''
+    Write count wheels of the given size into wheel_dir, with a requirements
+    file that installs them, and return the requirement lines
+    '''
+    # Seeded, so every run benchmarks the same wheels
+    rng = random.Random('{}-{}'.format(count, size))
+    names = [
+        'terrarium_benchmark_{}_{:04d}'.format(size, index)
+        for index in range(count)
+    ]
+    for name in names:
+        write_wheel(wheel_dir, name, '1.0', WHEEL_SIZES[size], rng)
+    requirements = ['{}==1.0'.format(name) for name in names]
+    with open(os.path.join(wheel_dir, 'requirements.txt'), 'w') as f:
+        f.write(terrarium.flatten_requirements(requirements))
+    return requirements
+
+
+def get_directory_size(directory):
+    return sum(
+        os.path.getsize(os.path.join(dirpath, filename))
+        for dirpath, dirnames, filenames in os.walk(directory)
+        for filename in filenames
+    )
+
+
+def measure(func, repeat):
+    '''
+    Call func repeat times, and return the time each call took with the
+    results of the calls. func is given the number of the call
+    '''
+    timings = []
+    results = []
+    for attempt in range(repeat):
+        start = time.time()
+        results.append(func(attempt))
+        timings.append(time.time() - start)
+    return timings, results
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    return {
+        'min': timings[0],
+        'median': timings[len(timings) // 2],
+        'max': timings[-1],
+        'timings': timings,
+    }
+
+
+def benchmark_wheel_set(name, requirements, wheel_dir, args, results):
+    '''
+    Time each stage on the wheels of wheel_dir, which requirements resolve to
+    '''
+    work_dir = tempfile.mkdtemp(prefix='terrarium-benchmark-')
+    wheels = [path for path in os.listdir(wheel_dir) if path.endswith('.whl')]
+    info = {
+        'wheel_set': name,
+        'wheels': len(wheels),
+        'bytes': get_directory_size(wheel_dir),
+    }
+
+    def add_result(stage, timings, **extra):
+        result = dict(info, stage=stage, **extra)
+        result.update(summarize(timings))
+        results.append(result)
+        logging.info(
+            '%s %s%s: %.3fs',
+            name,
+            stage,
+            ''.join(' {}={}'.format(key, value) for key, value in sorted(extra.items())),
+            result['min'],
+        )
+
+    def work_path(*names):
+        return os.path.join(work_dir, '-'.join(str(name) for name in names))
+
+    try:
+        if 'create_environment' in args.stages:
+            timings, archives = measure(
+                lambda attempt: terrarium.create_environment(
+                    requirements,
+                    compression=args.compressions[0],
+                ),
+                args.repeat,
+            )
+            add_result('create_environment', timings, compression=args.compressions[0])
+            for archive in archives:
+                os.remove(archive)
+
+        for compression in [None] + args.compressions:
+            if 'create_tar_archive' not in args.stages:
+                break
+            timings, archives = measure(
+                lambda attempt: terrarium.create_tar_archive(
+                    wheel_dir,
+                    compression=compression,
+                ),
+                args.repeat,
+            )
+            archive = archives[0]
+            add_result(
+                'create_tar_archive',
+                timings,
+                compression=compression,
+                archive_bytes=os.path.getsize(archive),
+            )
+            if 'extract_tar_archive' in args.stages:
+                timings, _ = measure(
+                    lambda attempt: terrarium.extract_tar_archive(
+                        archive,
+                        work_path('extract', attempt),
+                    ),
+                    args.repeat,
+                )
+                add_result('extract_tar_archive', timings, compression=compression)
+                for attempt in range(args.repeat):
+                    terrarium.rmtree(work_path('extract', attempt))
+            if compression is None and 'gzip_compress' in args.stages:
+                # gzip_compress replaces the file it compresses
+                copies = [work_path('gzip', attempt) for attempt in range(args.repeat)]
+                for copy in copies:
+                    shutil.copyfile(archive, copy)
+                timings, compressed = measure(
+                    lambda attempt: terrarium.gzip_compress(copies[attempt]),
+                    args.repeat,
+                )
+                add_result(
+                    'gzip_compress',
+                    timings,
+                    archive_bytes=os.path.getsize(compressed[0]),
+                )
+            for archive in archives:
+                os.remove(archive)
+
+        if 'create_virtualenv' in args.stages:
+            timings, _ = measure(
+                lambda attempt: terrarium.create_virtualenv(
+                    work_path('virtualenv', attempt),
+                ),
+                args.repeat,
+            )
+            add_result('create_virtualenv', timings)
+
+        for stage, install in [
+            ('pip_install_wheels', terrarium.pip_install_wheels),
+            ('install_wheels', lambda virtualenv, wheel_dir: terrarium.install_wheels(
+                virtualenv,
+                wheel_dir,
+                jobs=args.jobs,
+            )),
+        ]:
+            if stage not in args.stages:
+                continue
+            # Each install gets a fresh virtualenv, which is not timed
+            envs = [work_path(stage, attempt) for attempt in range(args.repeat)]
+            for env in envs:
+                terrarium.create_virtualenv(env)
+            timings, _ = measure(
+                lambda attempt: install(envs[attempt], wheel_dir),
+                args.repeat,
+            )
+            extra = {'jobs': args.jobs} if stage == 'install_wheels' else {}
+            add_result(stage, timings, **extra)
+            for env in envs:
+                terrarium.rmtree(env)
+    finally:
+        terrarium.rmtree(work_dir)
+
+
+def benchmark_fixtures(args, results):
+    'Time the stages on the wheels built from the test fixture packages'
+    requirements = [os.path.join(FIXTURES_DIR, name) for name in FIXTURES]
+    wheel_dir = tempfile.mkdtemp(prefix='terrarium-benchmark-wheels-')
+    try:
+        terrarium.pip_wheel(wheel_dir, requirements)
+        benchmark_wheel_set('fixtures', requirements, wheel_dir, args, results)
+    finally:
+        terrarium.rmtree(wheel_dir)
+
+
+def benchmark_generated(count, size, args, results):
+    'Time the stages on count generated wheels of the given size'
+    wheel_dir = tempfile.mkdtemp(prefix='terrarium-benchmark-wheels-')
+    try:
+        requirements = generate_wheel_set(wheel_dir, count, size)
+        # The wheels are only found in the generated directory
+        requirements = [
+            '--no-index',
+            '--find-links {}'.format(wheel_dir),
+        ] + requirements
+        benchmark_wheel_set(
+            '{}-{}'.format(count, size),
+            requirements,
+            wheel_dir,
+            args,
+            results,
+        )
+    finally:
+        terrarium.rmtree(wheel_dir)
+
+
+def parse_list(value):
+    return [item for item in value.split(',') if item]
+
+
+def define_args():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument(
+        '--counts',
+        type=lambda value: [int(count) for count in parse_list(value)],
+        default=WHEEL_COUNTS,
+        help='Comma separated numbers of generated wheels. Default is {}.'.format(
+            ','.join(str(count) for count in WHEEL_COUNTS),
+        ),
+    )
+    ap.add_argument(
+        '--sizes',
+        type=parse_list,
+        default=sorted(WHEEL_SIZES),
+        help='Comma separated sizes of generated wheels: {}.'.format(
+            ', '.join(sorted(WHEEL_SIZES)),
+        ),
+    )
+    ap.add_argument(
+        '--stages',
+        type=parse_list,
+        default=STAGES,
+        help='Comma separated stages to time. Default is all: {}.'.format(
+            ', '.join(STAGES),
+        ),
+    )
+    ap.add_argument(
+        '--compressions',
+        type=parse_list,
+        default=None,
+        help='''
+            Comma separated compressions to archive with. Default is all the
+            available ones.
+        ''',
+    )
+    ap.add_argument(
+        '--no-fixtures',
+        action='store_false',
+        dest='fixtures',
+        help='Do not benchmark the test fixture packages',
+    )
+    ap.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help='Number of times to time each stage. Default is 3.',
+    )
+    ap.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=4,
+        help='Number of parallel jobs for install_wheels. Default is 4.',
+    )
+    ap.add_argument(
+        '--output',
+        help='Write the results as JSON to this file instead of stdout',
+    )
+    return ap
+
+
+def get_available_compressions():
+    compressions = ['gzip']
+    if terrarium.zstandard:
+        compressions.append('zstd')
+    if terrarium.lz4:
+        compressions.append('lz4')
+    return compressions
+
+
+def main():
+    logging.basicConfig(
+        stream=sys.stderr,
+        level=logging.INFO,
+        format='[%(levelname)s] %(message)s',
+    )
+    # Only the benchmark progress, not the output of pip
+    terrarium.logger.setLevel(logging.WARNING)
+
+    ap = define_args()
+    args = ap.parse_args()
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        ap.error('unknown stages: {}'.format(', '.join(sorted(unknown))))
+    unknown = set(args.sizes) - set(WHEEL_SIZES)
+    if unknown:
+        ap.error('unknown sizes: {}'.format(', '.join(sorted(unknown))))
+    if args.compressions is None:
+        args.compressions = get_available_compressions()
+
+    results = []
+    if args.fixtures:
+        benchmark_fixtures(args, results)
+    for size in args.sizes:
+        for count in args.counts:
+            benchmark_generated(count, size, args, results)
+
+    report = {
+        'version': 1,
+        'terrarium_version': terrarium.TERRARIUM_VERSION,
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': terrarium.multiprocessing.cpu_count(),
+        'repeat': args.repeat,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,46 @@
 #!/usr/bin/env python
 from __future__ import absolute_import
 
+import ConfigParser
+import Queue
 import argparse
+import base64
+import collections
+import contextlib
+import csv
+import filecmp
+import functools
 import glob
+import gzip
 import hashlib
+import httplib
+import io
+import json
 import logging
+import multiprocessing
 import os
+import platform
+import random
+import re
 import shutil
+import socket
 import subprocess
 import sys
+import tarfile
 import tempfile
+import threading
+import time
+import urllib
+import urlparse
+import zipfile
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
 
 try:
     import boto  # noqa
     import boto.s3.connection
+    import boto.s3.key
+    import boto.s3.multipart
     import boto.exception
 except ImportError:
     boto = None  # noqa
@@ -24,6 +51,16 @@ try:
 except ImportError:
     gcs = None
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
 
 if __name__ == '__main__':
     __version__ = 'standalone'
@@ -46,16 +83,39 @@ PYTHONWARNINGS = [
     PYTHONWARNINGS_IGNORE_PIP_PYTHON2_DEPRECATION,
 ]
 
+# Read and write files in chunks of this many bytes
+CHUNK_SIZE = 1024 * 1024
+
+MIN_TRANSFER_PART_SIZE = 5 * 1024 * 1024
+
 
 class Terrarium(object):
     def __init__(self, args):
         self.args = args
         self._requirements = None
+        self._locked_requirements = None
+        # The distributions that the locked requirements are built from
+        self._resolve_dir = None
+        self._storage_backends = None
+        self.metrics = Metrics()
+        # Long lived threads, so their connections are reused by later
+        # lookups and transfers
+        self._probe_pools = {}
+        self._transfer_pool = None
+        self._part_pool = None
+        # Whether anything was moved to the trash, or a generation was added
+        # whose files are not shared yet, since the last reaper
+        self._trashed = False
+        self._unshared = False
 
     def get_digest(self):
+        requirements = self.requirements
+        if self.args.resolve:
+            requirements = self.locked_requirements
         return calculate_digest_for_requirements(
             digest_type=self.args.digest_type,
-            requirements=self.requirements,
+            requirements=requirements,
+            canonical=self.args.canonical_digest,
         )
 
     @property
@@ -72,6 +132,22 @@ class Terrarium(object):
         self._requirements = lines
         return self._requirements
 
+    @property
+    def locked_requirements(self):
+        if self._locked_requirements is None:
+            self._resolve_dir = tempfile.mkdtemp(prefix='terrarium-resolve-')
+            self._locked_requirements = resolve_requirements(
+                self.requirements,
+                self._resolve_dir,
+            )
+        return self._locked_requirements
+
+    def remove_resolve_dir(self):
+        'Remove the distributions downloaded to resolve the requirements'
+        if self._resolve_dir:
+            rmtree(self._resolve_dir)
+            self._resolve_dir = None
+
     def restore_previously_backed_up_environment(self):
         backup = self.get_backup_location()
         if not os.path.exists(backup):
@@ -81,8 +157,17 @@ class Terrarium(object):
             )
 
         target = self.get_target_location()
+        if os.path.islink(backup) and (
+            os.path.islink(target) or not os.path.exists(target)
+        ):
+            # Both are generations, switch the target back to the previous
+            # one in a single rename
+            logger.info('Switching %s to %s', target, os.readlink(backup))
+            os.rename(backup, target)
+            return
+
         logger.info('Deleting environment at %s', target)
-        rmtree(target)
+        self.remove_tree(target)
 
         logger.info('Renaming %s to %s', backup, target)
         move_or_rename(backup, target)
@@ -95,27 +180,276 @@ class Terrarium(object):
             target = self.get_target_location()
         return ''.join([target, self.args.backup_suffix])
 
+    def get_trash_location(self):
+        return '{}.trash'.format(self.get_target_location())
+
+    def remove_tree(self, path):
+        '''
+        Remove path. With --background-delete, it is only renamed into the
+        trash, and removed later by start_reaper or the gc command
+        '''
+        if not self.args.background_delete or not os.path.lexists(path):
+            rmtree(path)
+            return
+        trash = self.get_trash_location()
+        if not os.path.exists(trash):
+            os.makedirs(trash)
+        # Unique, so trees with the same name can be retired concurrently
+        dest = os.path.join(trash, '{}.{}'.format(
+            os.path.basename(path),
+            os.urandom(8).encode('hex'),
+        ))
+        logger.debug('Moving %s to %s', path, dest)
+        try:
+            os.rename(path, dest)
+        except OSError:
+            # The trash is on another filesystem
+            rmtree(path)
+            return
+        self._trashed = True
+
+    def start_reaper(self):
+        '''
+        Empty the trash and share the files of the generations in a detached
+        terrarium gc process at low CPU and IO priority, so this one can exit
+        without waiting for it
+        '''
+        if not self._trashed and not self._unshared:
+            return
+        command = [
+            sys.executable,
+            os.path.abspath(sys.argv[0]),
+            '--target', self.get_target_location(),
+            'gc',
+        ]
+        if find_executable('ionice'):
+            # Idle IO scheduling class
+            command = ['ionice', '-c', '3'] + command
+        logger.debug('start_reaper: %s', command)
+        with open(os.devnull, 'r+') as devnull:
+            subprocess.Popen(
+                command,
+                stdin=devnull,
+                stdout=devnull,
+                stderr=devnull,
+                close_fds=True,
+                preexec_fn=start_reaper_session,
+            )
+        self._trashed = False
+        self._unshared = False
+
+    def collect_garbage(self):
+        'Remove everything in the trash of the target'
+        trash = self.get_trash_location()
+        if not os.path.exists(trash):
+            return
+        names = os.listdir(trash)
+        for name in names:
+            try:
+                rmtree(os.path.join(trash, name))
+            except RuntimeError as e:
+                # Another gc may be removing it too
+                logger.warning(e)
+        logger.info('Removed %s trees from %s', len(names), trash)
+
+    def get_generations_location(self):
+        return '{}.generations'.format(self.get_target_location())
+
+    def make_generation_location(self):
+        'Return the path of the next generation of the target'
+        generations = self.get_generations_location()
+        if not os.path.exists(generations):
+            os.makedirs(generations)
+        numbers = [
+            int(name)
+            for name in os.listdir(generations)
+            if name.isdigit()
+        ]
+        return os.path.join(generations, str(max(numbers or [0]) + 1))
+
+    def migrate_to_generations(self):
+        '''
+        Move an environment that was installed without --generations into
+        the first generation, and point the target at it
+        '''
+        target = self.get_target_location()
+        if os.path.islink(target) or not os.path.exists(target):
+            return
+        generation = self.make_generation_location()
+        logger.info('Moving %s to %s', target, generation)
+        move_or_rename(target, generation)
+        replace_symlink(generation, target, remove=self.remove_tree)
+
+    def switch_generation(self, generation):
+        '''
+        Point the target at generation, and the backup at the generation the
+        target pointed at before, replacing each symlink with a rename
+        '''
+        target = self.get_target_location()
+        backup = self.get_backup_location()
+
+        previous = None
+        if os.path.islink(target):
+            previous = os.path.realpath(target)
+
+        logger.info('Switching %s to %s', target, generation)
+        replace_symlink(generation, target, remove=self.remove_tree)
+        if previous and self.args.backup:
+            replace_symlink(previous, backup, remove=self.remove_tree)
+        elif os.path.islink(backup) or not self.args.backup:
+            self.remove_tree(backup)
+        self.remove_old_generations(generation)
+        if previous and self.args.backup:
+            # Comparing whole environments takes a while, so the files are
+            # shared by the reaper once the new generation is in use
+            self._unshared = True
+
+    def share_generations(self):
+        '''
+        Hard link the files of each retained generation up to the one the
+        target points at to the identical files of the generation before it.
+        Later ones may still be being installed.
+        '''
+        target = self.get_target_location()
+        generations = self.get_generations_location()
+        if not os.path.islink(target) or not os.path.isdir(generations):
+            return
+        current = int(os.path.basename(os.path.realpath(target)))
+        numbers = sorted(
+            int(name)
+            for name in os.listdir(generations)
+            if name.isdigit() and int(name) <= current
+        )
+        for older, newer in zip(numbers, numbers[1:]):
+            saved = link_identical_files(
+                os.path.join(generations, str(older)),
+                os.path.join(generations, str(newer)),
+            )
+            logger.info(
+                'Shared %s bytes of generation %s with generation %s',
+                saved,
+                newer,
+                older,
+            )
+
+    def remove_old_generations(self, current):
+        '''
+        Remove the generations before current, except the --keep-generations
+        latest ones and the ones the target or the backup point at. Later
+        ones may still be being installed.
+        '''
+        generations = self.get_generations_location()
+        in_use = set(
+            os.path.realpath(path)
+            for path in [self.get_target_location(), self.get_backup_location()]
+            if os.path.islink(path)
+        )
+        current_number = int(os.path.basename(current))
+        numbers = sorted(
+            (
+                int(name)
+                for name in os.listdir(generations)
+                if name.isdigit() and int(name) <= current_number
+            ),
+            reverse=True,
+        )
+        keep = self.args.keep_generations if self.args.backup else 1
+        for number in numbers[keep:]:
+            path = os.path.join(generations, str(number))
+            if os.path.realpath(path) not in in_use:
+                logger.debug('Removing generation %s', path)
+                self.remove_tree(path)
+
+    def switch_to_generation(self, number):
+        'Point the target at a retained generation'
+        self.migrate_to_generations()
+        generation = os.path.join(self.get_generations_location(), str(number))
+        if not os.path.isdir(generation):
+            raise RuntimeError(
+                'Failed to revert to generation {}. '
+                "It doesn't appear to exist at {}".format(number, generation),
+            )
+        target = self.get_target_location()
+        logger.info('Switching %s to %s', target, generation)
+        replace_symlink(generation, target, remove=self.remove_tree)
+
     def install(self):
         '''
         1. Attempt to download prebuilt environment
         2. Otherwise, attempt to build one (unless prohibited)
         3. If there's already an existing environment,
             temporarily move it out of the way.
-        4. Install the environment from either #2 or #1
+        4. Install the environment from either #2 or #1. With --incremental,
+            only the differences are installed into the existing environment.
+            With --delta, a delta from the environment at the target is
+            downloaded and applied in place when one exists. With
+            --relocatable, the downloaded virtualenv is moved to the target
+            and relocated instead
         5. If installation fails, restore the previous environment
-        6. Otherwise, move the previous environment to the backup location
+        6. Otherwise, move the previous environment to the backup location.
+            With --generations, the environment is installed into a new
+            directory instead, and the target and backup symlinks are
+            switched to it and the previous one
         '''
         target_path = self.get_target_location()
         backup_path = self.get_backup_location()
+        if self.args.generations:
+            # Installed into a new directory, which the target is switched to
+            # once it is complete
+            self.migrate_to_generations()
+            target_path = self.make_generation_location()
 
         existing_target = os.path.exists(target_path)
         existing_backup = os.path.exists(backup_path)
+        relocatable = self.is_relocatable()
+
+        base = None
+        if all([
+            self.args.delta,
+            not self.args.dedup,
+            not relocatable,
+            existing_target,
+            is_virtualenv(target_path),
+        ]):
+            base = read_environment_info(target_path)
 
+        metrics = self.metrics
+        metrics.label('key', self.make_remote_key())
         downloaded = False
+        local_archive_path = None
+        wheel_dir = None
+        delta_dir = None
+        # The downloaded virtualenv of a relocatable environment
+        venv_dir = None
         if self.args.download:
-            local_archive_path = self.download()
-            if local_archive_path:
+            with metrics.phase('download'):
+                delta_dir = self.download_delta(base)
+                wheel_dir = delta_dir or self.link_wheels_from_storage_dir()
+                if delta_dir:
+                    metrics.label('source', 'delta')
+                elif wheel_dir:
+                    metrics.label('source', 'storage_dir_wheels')
+                elif self.args.dedup:
+                    metrics.label('source', 'dedup')
+                    wheel_dir = self.download_dedup()
+                elif self.args.stream and relocatable:
+                    metrics.label('source', 'stream')
+                    venv_dir = self.make_venv_dir(target_path)
+                    if not self.download_and_extract(venv_dir, external_symlinks=True):
+                        rmtree(venv_dir)
+                        venv_dir = None
+                elif self.args.stream:
+                    metrics.label('source', 'stream')
+                    wheel_dir = tempfile.mkdtemp(prefix='terrarium-wheel-')
+                    if not self.download_and_extract(wheel_dir):
+                        rmtree(wheel_dir)
+                        wheel_dir = None
+                else:
+                    metrics.label('source', 'archive')
+                    local_archive_path = self.download()
+            if wheel_dir or venv_dir or local_archive_path:
                 downloaded = True
+        metrics.label('cache', 'hit' if downloaded else 'miss')
 
         new_env_created = False
         if not downloaded:
@@ -124,98 +458,428 @@ class Terrarium(object):
                     'Failed to download environment and download is required. '
                     'Refusing to build a new environment.'
                 )
-            local_archive_path = create_environment(self.requirements)
-            if local_archive_path:
+            metrics.label('source', 'build')
+            locked_requirements = (
+                self.locked_requirements if self.args.resolve else None
+            )
+            with metrics.phase('build'):
+                if self.args.dedup:
+                    # Deduplicated environments are uploaded file by file,
+                    # so the wheels are installed from where they were built
+                    wheel_dir = build_wheels(
+                        self.requirements,
+                        wheel_cache_dir=self.args.wheel_cache_dir,
+                        jobs=self.args.jobs,
+                        locked_requirements=locked_requirements,
+                        download_dir=self._resolve_dir,
+                    )
+                else:
+                    local_archive_path = create_environment(
+                        self.requirements,
+                        compress=self.args.compress,
+                        wheel_cache_dir=self.args.wheel_cache_dir,
+                        jobs=self.args.jobs,
+                        compression=self.args.compression,
+                        compression_level=self.args.compression_level,
+                        compression_threads=self.args.compression_threads,
+                        locked_requirements=locked_requirements,
+                        download_dir=self._resolve_dir,
+                    )
+            if local_archive_path or wheel_dir:
                 new_env_created = True
 
-        if not local_archive_path:
+        if not local_archive_path and not wheel_dir and not venv_dir:
             raise RuntimeError('No environment was downloaded or created')
 
+        if local_archive_path:
+            metrics.count('archive', os.path.getsize(local_archive_path))
+        try:
+            if relocatable and downloaded and not venv_dir:
+                with metrics.phase('extract'):
+                    venv_dir = self.make_venv_dir(target_path)
+                    extract_tar_archive(
+                        local_archive_path,
+                        venv_dir,
+                        # A virtualenv links to the standard library
+                        external_symlinks=True,
+                    )
+            elif not wheel_dir and not venv_dir:
+                with metrics.phase('extract'):
+                    wheel_dir = tempfile.mkdtemp(prefix='terrarium-wheel-')
+                    extract_tar_archive(local_archive_path, wheel_dir)
+        finally:
+            if downloaded and local_archive_path:
+                self.remove_downloaded_archive(local_archive_path)
+        if wheel_dir:
+            metrics.count('wheels', get_directory_size(wheel_dir))
+
+        if all([
+            self.args.storage_dir_wheels,
+            self.args.upload,
+            wheel_dir,
+            not delta_dir,
+        ]):
+            with metrics.phase('upload'):
+                self.upload_wheels_to_storage_dir(wheel_dir)
+
+        # A delta can only be applied in place
+        incremental = bool(delta_dir) or all([
+            not relocatable,
+            self.args.incremental,
+            existing_target,
+            is_virtualenv(target_path),
+        ])
+
         target_path_temp = target_path + '.temp'
+        if incremental:
+            # Keep a pristine copy for the rollback and the backup, and
+            # update the existing environment in place
+            with metrics.phase('backup'):
+                clone_virtualenv(target_path, target_path_temp)
         try:
-            if existing_target:
-                move_or_rename(target_path, target_path_temp)
-            install_environment(local_archive_path, target_path)
+            if existing_target and not incremental:
+                with metrics.phase('backup'):
+                    move_or_rename(target_path, target_path_temp)
+            if delta_dir:
+                with metrics.phase('install'):
+                    pip_apply_delta(target_path, delta_dir)
+                wheels = read_delta_info(delta_dir)['wheels']
+            elif venv_dir:
+                with metrics.phase('install'):
+                    move_or_rename(venv_dir, target_path)
+                    relocate_virtualenv(target_path)
+                with metrics.phase('compile'):
+                    verify_bytecode(target_path, jobs=self.args.jobs)
+            else:
+                install_wheel_dir(
+                    wheel_dir,
+                    target_path,
+                    incremental=incremental,
+                    fast=self.args.fast_install,
+                    jobs=self.args.jobs,
+                    metrics=metrics,
+                    # Compiled in parallel below instead
+                    compile=not relocatable,
+                )
+                wheels = None
+                if relocatable:
+                    with metrics.phase('compile'):
+                        compile_virtualenv(target_path, jobs=self.args.jobs)
+            if self.args.delta and not relocatable:
+                write_environment_info(target_path, {
+                    'version': 1,
+                    'key': self.make_remote_key(),
+                    'digest': self.get_digest(),
+                    'wheels': wheels or get_wheel_digests(wheel_dir),
+                })
+            elif relocatable and not venv_dir:
+                # Records where the virtualenv was built, to relocate it from
+                write_environment_info(target_path, {
+                    'version': 1,
+                    'key': self.make_remote_key(),
+                    'digest': self.get_digest(),
+                    'prefix': target_path,
+                })
         except: # noqa - is there a better way to do this?
+            if venv_dir and os.path.exists(venv_dir):
+                self.remove_tree(venv_dir)
+            if self.args.generations:
+                self.remove_tree(target_path)
             if existing_target:
                 # restore the original environment
-                rmtree(target_path)
+                self.remove_tree(target_path)
                 move_or_rename(target_path_temp, target_path)
             raise
 
-        if existing_backup:
-            logger.debug('Removing backup path')
-            rmtree(backup_path)
+        if self.args.generations:
+            with metrics.phase('backup'):
+                self.switch_generation(target_path)
+        else:
+            with metrics.phase('backup'):
+                if existing_backup:
+                    logger.debug('Removing backup path')
+                    self.remove_tree(backup_path)
 
-        if existing_target:
-            if self.args.backup:
-                move_or_rename(target_path_temp, backup_path)
-            else:
-                rmtree(target_path_temp)
+                if existing_target:
+                    if self.args.backup:
+                        move_or_rename(target_path_temp, backup_path)
+                    else:
+                        self.remove_tree(target_path_temp)
 
         if new_env_created and self.args.upload:
-            self.upload(local_archive_path)
+            with metrics.phase('upload'):
+                if self.args.dedup:
+                    self.upload_dedup(wheel_dir)
+                elif relocatable:
+                    self.upload_virtualenv(target_path)
+                else:
+                    self.upload(local_archive_path)
+                    if base and base['key'] != self.make_remote_key():
+                        self.upload_delta(wheel_dir, base)
+        metrics.label('success', True)
 
-    def _get_s3_bucket(self):
-        conn = boto.s3.connection.S3Connection(
-            aws_access_key_id=self.args.s3_access_key,
-            aws_secret_access_key=self.args.s3_secret_key
+    def is_relocatable(self):
+        return self.args.relocatable and not self.args.dedup
+
+    def make_venv_dir(self, target_path):
+        '''
+        Return a new directory next to target_path, so the virtualenv
+        downloaded into it can be renamed into place
+        '''
+        parent = os.path.dirname(target_path)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        return tempfile.mkdtemp(
+            prefix='.{}-'.format(os.path.basename(target_path)),
+            dir=parent,
         )
-        return boto.s3.bucket.Bucket(conn, name=self.args.s3_bucket)
 
-    def _get_gcs_bucket(self):
-        conn = gcs.get_connection(
-            self.args.gcs_project,
-            self.args.gcs_client_email,
-            self.args.gcs_private_key
+    def upload_virtualenv(self, virtualenv):
+        'Archive the installed virtualenv, and upload it'
+        archive = create_tar_archive(
+            virtualenv,
+            compression=self.args.compression if self.args.compress else None,
+            compression_level=self.args.compression_level,
+            compression_threads=self.args.compression_threads,
         )
-        return conn.get_bucket(self.args.gcs_bucket)
+        logger.info('Uploading virtualenv of %s', virtualenv)
+        self.upload(archive)
 
-    def download(self):
-        local_path = make_temp_file(suffix='.tea')
+    def get_storage_backends(self):
+        '''
+        Return the configured storage backends, the ones that answered lookups
+        faster first
+        '''
+        if self._storage_backends is None:
+            self._storage_backends = [
+                backend_class(self)
+                for backend_class in STORAGE_BACKENDS.values()
+                if backend_class.is_configured(self.args)
+            ]
+            latencies = self.load_latencies()
+            for backend in self._storage_backends:
+                backend.latency = latencies.get(backend.description, backend.latency)
+        return sorted(
+            self._storage_backends,
+            key=lambda backend: backend.latency,
+        )
 
-        # make remote key for extenal storage system
-        remote_key = self.make_remote_key()
+    def load_latencies(self):
+        '''
+        Return the lookup latencies saved to --latency-file by earlier runs,
+        by backend description
+        '''
+        path = self.args.latency_file
+        if not path or not os.path.exists(path):
+            return {}
+        try:
+            with open(path) as f:
+                return dict(json.load(f))
+        except (IOError, ValueError, TypeError) as e:
+            # Only a hint, so a damaged file is measured again
+            logger.debug('Ignoring latency file %s: %s', path, e)
+            return {}
 
-        if self.args.storage_dir:
-            local_path = os.path.join(self.args.storage_dir, remote_key)
-            if os.path.exists(local_path):
-                return local_path
+    def save_latencies(self):
+        'Save the lookup latencies of the storage backends to --latency-file'
+        path = self.args.latency_file
+        if not path:
+            return
+        # Keep the backends that this run does not use
+        latencies = self.load_latencies()
+        latencies.update(
+            (backend.description, backend.latency)
+            for backend in self._storage_backends
+        )
+        parent = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        # Renamed into place, so concurrent runs never read a partial file
+        temp = make_temp_file(dir=parent)
+        with open(temp, 'w') as f:
+            json.dump(latencies, f, indent=2, sort_keys=True)
+        os.rename(temp, path)
 
-        if self._download_from_s3(remote_key, local_path):
-            return local_path
+    def report_metrics(self, command):
+        'Write the metrics of command to the configured reports'
+        metrics = self.metrics.as_dict()
+        metrics['labels'].update(
+            command=command,
+            success=bool(metrics['labels'].get('success')),
+        )
+        prefix = '{}.{}'.format(self.args.metrics_prefix, command)
+        if self.args.metrics_file:
+            write_metrics_file(self.args.metrics_file, metrics)
+        if self.args.statsd_address:
+            send_statsd_metrics(self.args.statsd_address, prefix, metrics)
+        if self.args.prometheus_textfile:
+            write_prometheus_textfile(self.args.prometheus_textfile, prefix, metrics)
 
-        if self._download_from_gcs(remote_key, local_path):
-            return local_path
+    def get_writable_storage_backends(self):
+        return [
+            backend for backend in self.get_storage_backends()
+            if backend.writable
+        ]
 
-    def _download_from_s3(self, remote_key, local_path):
-        if not boto or not self.args.s3_bucket:
-            return
-        bucket = self._get_s3_bucket()
-        key = bucket.get_key(remote_key)
-        if not key:
-            return
-        logger.info(
-            'Downloading %s/%s from S3 ...',
-            self.args.s3_bucket,
-            remote_key,
+    def _get_probe_pool(self, backend):
+        'Return the thread that looks up objects in backend'
+        if backend.name not in self._probe_pools:
+            self._probe_pools[backend.name] = ThreadPool(1)
+        return self._probe_pools[backend.name]
+
+    def _get_transfer_pool(self):
+        if self._transfer_pool is None:
+            self._transfer_pool = ThreadPool(max(1, self.args.transfer_workers))
+        return self._transfer_pool
+
+    def map_transfers(self, func, items):
+        'Call func for each of items in the transfer threads'
+        return map_parallel(
+            func,
+            items,
+            self.args.transfer_workers,
+            pool=self._get_transfer_pool(),
         )
-        key.get_contents_to_filename(local_path)
-        return True
 
-    def _download_from_gcs(self, remote_key, local_path):
-        if not gcs or not self.args.gcs_bucket:
-            return
-        bucket = self._get_gcs_bucket()
-        blob = bucket.get_key(remote_key)
-        if not blob:
-            return
-        logger.info(
-            'Downloading %s/%s from Google Cloud Storage ...',
-            self.args.gcs_bucket,
-            remote_key,
+    def _get_part_pool(self):
+        if self._part_pool is None:
+            self._part_pool = ThreadPool(max(1, self.args.transfer_workers))
+        return self._part_pool
+
+    def map_parts(self, func, items):
+        '''
+        Call func for each of the parts of a single transfer in the part
+        threads. Transfers may run in the transfer threads themselves, which
+        would wait forever for parts queued behind them in the same pool.
+        '''
+        return map_parallel(
+            func,
+            items,
+            self.args.transfer_workers,
+            pool=self._get_part_pool(),
         )
-        blob.download_to_file(local_path)
+
+    def find_object(self, name):
+        '''
+        Look up name in all storage backends concurrently, and return the
+        first backend that has it with its StoredObject. The lookups that are
+        still running are abandoned, so a slow or distant backend only delays
+        the install when no faster one has the object. The time each lookup
+        took is kept to rank the backends, and saved to --latency-file so
+        later runs start from it
+        '''
+        backends = self.get_storage_backends()
+        results = Queue.Queue()
+        start = time.time()
+
+        def probe(backend):
+            start = time.time()
+            try:
+                obj = backend.head(name)
+            except Exception as e:
+                obj, error = None, e
+            else:
+                error = None
+            elapsed = time.time() - start
+            backend.latency = elapsed
+            results.put((backend, obj, elapsed, error))
+
+        for backend in backends:
+            self._get_probe_pool(backend).apply_async(probe, (backend,))
+
+        errors = []
+        pending = set(backends)
+        while pending:
+            backend, obj, elapsed, error = results.get()
+            pending.discard(backend)
+            if error is not None:
+                logger.warning(
+                    'Failed to look up %s in %s after %.3fs: %s',
+                    name,
+                    backend.name,
+                    elapsed,
+                    error,
+                )
+                errors.append(error)
+            elif obj is None:
+                logger.debug('%s not in %s after %.3fs', name, backend.name, elapsed)
+            else:
+                logger.debug('Found %s in %s after %.3fs', name, backend.name, elapsed)
+                self.metrics.label('backend', backend.name)
+                break
+        else:
+            backend = obj = None
+        for slower in pending:
+            # Abandoned lookups took at least this long
+            slower.latency = max(slower.latency, time.time() - start)
+        self.save_latencies()
+        if obj is None and errors:
+            raise errors[0]
+        return backend, obj
+
+    def download(self, remote_key=None):
+        '''
+        Return the path of the archive of remote_key. An archive in the
+        storage directory is used where it is, and one downloaded from
+        elsewhere is kept in the storage directory for the next run.
+        Without a storage directory it is downloaded to a temporary file,
+        see remove_downloaded_archive.
+        '''
+        # make remote key for extenal storage system
+        if remote_key is None:
+            remote_key = self.make_remote_key()
+
+        backend, obj = self.find_object(remote_key)
+        if backend is None:
+            return
+        storage_dir = self.get_storage_dir_backend()
+        if backend is storage_dir:
+            logger.info('Using %s from %s', remote_key, backend.description)
+            return backend.get_path(obj.name)
+        logger.info('Downloading %s from %s ...', remote_key, backend.description)
+        if storage_dir:
+            local_path = storage_dir.get_path(remote_key)
+            parent = os.path.dirname(local_path)
+            if not os.path.exists(parent):
+                os.makedirs(parent)
+            # Renamed into place once complete
+            temp = make_temp_file(suffix='.tea', dir=parent)
+        else:
+            local_path = temp = make_temp_file(suffix='.tea')
+        try:
+            backend.get(obj, temp)
+        except: # noqa - is there a better way to do this?
+            os.remove(temp)
+            raise
+        self.metrics.count('downloaded', os.path.getsize(temp))
+        move_or_rename(temp, local_path)
+        return local_path
+
+    def get_storage_dir_backend(self):
+        for backend in self.get_storage_backends():
+            if isinstance(backend, StorageDirBackend):
+                return backend
+
+    def remove_downloaded_archive(self, path):
+        'Remove an archive returned by download, unless it is kept in the storage directory'
+        if not self.args.storage_dir or not is_within(path, self.args.storage_dir):
+            os.remove(path)
+
+    def download_and_extract(self, wheel_dir, external_symlinks=False):
+        '''
+        Like download, but extracts the archive into wheel_dir while it is
+        being downloaded, without writing the archive itself to disk
+        '''
+        backend, obj = self.find_object(self.make_remote_key())
+        if backend is None:
+            return False
+        logger.info('Streaming %s from %s ...', obj.name, backend.description)
+        f = CountingStream(backend.open(obj.name))
+        try:
+            extract_tar_stream(f, wheel_dir, external_symlinks=external_symlinks)
+        finally:
+            f.close()
+            self.metrics.count('downloaded', f.count)
         return True
 
     def make_remote_key(self):
@@ -228,70 +892,948 @@ class Terrarium(object):
             'python_vpatch': patch,
             'arch': platform.machine(),
         }
-        return self.args.remote_key_format % context
+        key = self.args.remote_key_format % context
+        if self.is_relocatable():
+            # Built virtualenvs are stored apart from the wheels
+            key = '{}.venv'.format(key)
+        return key
 
-    def upload_to_storage_dir(self, archive, storage_dir):
-        logger.info('Copying environment to storage directory')
-        dest = os.path.join(storage_dir, self.make_remote_key())
+    def get_storage_dir_wheels_location(self):
+        return os.path.join(
+            self.args.storage_dir,
+            '{}.wheels'.format(self.make_remote_key()),
+        )
+
+    def link_wheels_from_storage_dir(self):
+        '''
+        Hard link the extracted wheels of the environment from the storage
+        directory into a new temporary directory, and return it
+        '''
+        if not self.args.storage_dir or not self.args.storage_dir_wheels:
+            return
+        src = self.get_storage_dir_wheels_location()
+        if not os.path.isdir(src):
+            return
+        logger.info('Linking wheels from %s', src)
+        wheel_dir = tempfile.mkdtemp(prefix='terrarium-wheel-')
+        link_tree(src, wheel_dir)
+        return wheel_dir
+
+    def upload_wheels_to_storage_dir(self, wheel_dir):
+        dest = self.get_storage_dir_wheels_location()
         if os.path.exists(dest):
-            raise RuntimeError(
-                'Environment already exists at {}'.format(dest),
+            return
+        logger.info('Copying extracted wheels to storage directory')
+        temp = tempfile.mkdtemp(prefix='terrarium-', dir=self.args.storage_dir)
+        link_tree(wheel_dir, temp)
+        # The wheels are shared by hard links, and must never be modified
+        for name in os.listdir(temp):
+            os.chmod(os.path.join(temp, name), 0o444)
+        os.chmod(temp, 0o755)
+        try:
+            os.rename(temp, dest)
+        except OSError:
+            # Another install stored the same wheels first
+            rmtree(temp)
+
+    def upload(self, archive, remote_key=None):
+        if remote_key is None:
+            remote_key = self.make_remote_key()
+        for backend in self.get_writable_storage_backends():
+            logger.info('Uploading %s to %s', remote_key, backend.description)
+            backend.put(archive, remote_key, overwrite=False)
+            self.metrics.count('uploaded', os.path.getsize(archive))
+        logger.debug('upload finished')
+
+    def get_delta_key(self, base):
+        return '{}.delta-{}'.format(self.make_remote_key(), base['digest'])
+
+    def download_delta(self, base):
+        '''
+        Download and extract the delta from the base environment installed at
+        the target to the new environment, and return the extracted directory
+        '''
+        if not base or base['key'] == self.make_remote_key():
+            return
+        archive = self.download(self.get_delta_key(base))
+        if not archive:
+            logger.info('No delta from %s, using the full environment', base['key'])
+            return
+        delta_dir = tempfile.mkdtemp(prefix='terrarium-delta-')
+        try:
+            extract_tar_archive(archive, delta_dir)
+        finally:
+            self.remove_downloaded_archive(archive)
+        if read_delta_info(delta_dir)['base'] != base['key']:
+            logger.warning('Delta does not apply to %s, ignoring it', base['key'])
+            rmtree(delta_dir)
+            return
+        logger.info('Installing delta from %s', base['key'])
+        return delta_dir
+
+    def upload_delta(self, wheel_dir, base):
+        '''
+        Upload the wheels of wheel_dir that are missing from or differ in the
+        base environment, with the distributions to remove from it
+        '''
+        wheels = get_wheel_digests(wheel_dir)
+        changed = sorted(
+            name for name, digest in wheels.items()
+            if base['wheels'].get(name) != digest
+        )
+        names = set(parse_wheel_filename(name)[0] for name in wheels)
+        remove = sorted(set(
+            parse_wheel_filename(name)[0] for name in base['wheels']
+        ) - names)
+
+        delta_dir = tempfile.mkdtemp(prefix='terrarium-delta-')
+        for name in changed + ['requirements.txt', 'requirements.lock']:
+            path = os.path.join(wheel_dir, name)
+            if os.path.exists(path):
+                link_or_copy(path, os.path.join(delta_dir, name))
+        write_file(
+            os.path.join(delta_dir, DELTA_INFO_NAME),
+            json.dumps({
+                'version': 1,
+                'base': base['key'],
+                'remove': remove,
+                'wheels': wheels,
+            }, indent=2, sort_keys=True),
+        )
+        archive = create_tar_archive(
+            delta_dir,
+            compression=self.args.compression if self.args.compress else None,
+            compression_level=self.args.compression_level,
+            compression_threads=self.args.compression_threads,
+        )
+        logger.info(
+            'Uploading delta from %s with %s of %s wheels',
+            base['key'],
+            len(changed),
+            len(wheels),
+        )
+        self.upload(archive, self.get_delta_key(base))
+
+    def get_manifest_name(self):
+        return '{}.manifest'.format(self.make_remote_key())
+
+    def download_dedup(self):
+        '''
+        Download the manifest of the environment and the files it lists that
+        are missing from the blob cache, and return a new wheel directory
+        '''
+        manifest_name = self.get_manifest_name()
+        backend, obj = self.find_object(manifest_name)
+        if backend is None:
+            return
+        manifest_path = make_temp_file(suffix='.manifest')
+        try:
+            backend.get(obj, manifest_path)
+            self.metrics.count('downloaded', os.path.getsize(manifest_path))
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        finally:
+            os.remove(manifest_path)
+        files = manifest['files']
+
+        blob_dir = self.args.blob_cache_dir
+        if not blob_dir:
+            blob_dir = tempfile.mkdtemp(prefix='terrarium-blobs-')
+        elif not os.path.exists(blob_dir):
+            os.makedirs(blob_dir)
+        try:
+            return self.link_blobs(backend, obj, files, blob_dir)
+        finally:
+            if not self.args.blob_cache_dir:
+                # The wheel directory has its own links to the blobs
+                rmtree(blob_dir)
+
+    def link_blobs(self, backend, manifest, files, blob_dir):
+        '''
+        Download the files missing from blob_dir and link them into a new
+        wheel directory under the names in files
+        '''
+        missing = sorted(set(
+            entry['sha256'] for entry in files.values()
+            if not os.path.exists(os.path.join(blob_dir, entry['sha256']))
+        ))
+        logger.info(
+            'Downloading %s of %s files of %s from %s',
+            len(missing),
+            len(files),
+            manifest.name,
+            backend.name,
+        )
+        sizes = dict((entry['sha256'], entry['size']) for entry in files.values())
+
+        def download_blob(digest):
+            temp = make_temp_file(dir=blob_dir)
+            # The manifest has the size and digest, so the blob is not looked up
+            blob = StoredObject(
+                get_blob_name(digest),
+                sizes[digest],
+                'sha256',
+                digest,
+                # Stored like the manifest
+                manifest.supports_ranges,
+            )
+            backend.get(blob, temp)
+            move_or_rename(temp, os.path.join(blob_dir, digest))
+
+        self.map_transfers(download_blob, missing)
+        self.metrics.count('downloaded', sum(sizes[digest] for digest in missing))
+
+        wheel_dir = tempfile.mkdtemp(prefix='terrarium-wheel-')
+        for name, entry in files.items():
+            link_or_copy(
+                os.path.join(blob_dir, entry['sha256']),
+                os.path.join(wheel_dir, name),
+            )
+        return wheel_dir
+
+    def upload_dedup(self, wheel_dir):
+        '''
+        Upload the files of wheel_dir that each storage backend does not
+        have yet, followed by the manifest of the environment
+        '''
+        files = {}
+        for name in sorted(os.listdir(wheel_dir)):
+            path = os.path.join(wheel_dir, name)
+            files[name] = {
+                'sha256': file_digest(path, 'sha256'),
+                'size': os.path.getsize(path),
+            }
+        paths = dict(
+            (entry['sha256'], os.path.join(wheel_dir, name))
+            for name, entry in files.items()
+        )
+        manifest_path = make_temp_file(suffix='.manifest')
+        try:
+            with open(manifest_path, 'w') as f:
+                json.dump({'version': 1, 'files': files}, f, indent=2, sort_keys=True)
+            self.upload_blobs(files, paths, manifest_path)
+        finally:
+            os.remove(manifest_path)
+
+    def upload_blobs(self, files, paths, manifest_path):
+        '''
+        Upload the files in paths, keyed by digest, that each storage
+        backend does not have yet, followed by the manifest
+        '''
+        for backend in self.get_writable_storage_backends():
+            # A single listing instead of a lookup for each file
+            existing = set(backend.list(get_blob_name('')))
+            missing = [
+                digest for digest in sorted(paths)
+                if get_blob_name(digest) not in existing
+            ]
+            logger.info(
+                'Uploading %s of %s files to %s',
+                len(missing),
+                len(files),
+                backend.name,
+            )
+            self.map_transfers(
+                lambda digest: backend.put(paths[digest], get_blob_name(digest)),
+                missing,
+            )
+            # Uploaded last, so it never refers to missing files
+            backend.put(manifest_path, self.get_manifest_name())
+            self.metrics.count('uploaded', sum(
+                os.path.getsize(path)
+                for path in [manifest_path] + [paths[digest] for digest in missing]
+            ))
+
+
+def get_blob_name(digest):
+    return 'blobs/{}'.format(digest)
+
+
+def map_parallel(func, items, workers, pool=None):
+    '''
+    Call func for each of items, using up to workers threads, or the threads
+    of pool when given
+    '''
+    if not items:
+        return []
+    if pool is not None:
+        return pool.map(func, items)
+    pool = ThreadPool(max(1, min(workers, len(items))))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class Metrics(object):
+    '''
+    The time each phase of a command took, the bytes it handled and its
+    outcome, for the --metrics-file, --statsd-address and
+    --prometheus-textfile reports
+    '''
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = collections.OrderedDict()
+        self.counts = collections.OrderedDict()
+        self.labels = collections.OrderedDict()
+        # Transfers are counted from several threads
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        'Add the time the with block takes to the phase name'
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._add(self.phases, name, time.time() - start)
+
+    def count(self, name, value):
+        'Add value bytes to the count name'
+        self._add(self.counts, name, value)
+
+    def label(self, name, value):
+        self.labels[name] = value
+
+    def _add(self, values, name, value):
+        with self._lock:
+            values[name] = values.get(name, 0) + value
+
+    def as_dict(self):
+        return {
+            'time': self.start,
+            'seconds': time.time() - self.start,
+            'phases': self.phases,
+            'bytes': self.counts,
+            'labels': self.labels,
+        }
+
+
+def write_metrics_file(path, metrics):
+    'Append metrics to path as a line of JSON'
+    with open(path, 'a') as f:
+        f.write(json.dumps(metrics, sort_keys=True) + '\n')
+
+
+def send_statsd_metrics(address, prefix, metrics):
+    'Send metrics to the StatsD daemon at address, which is host:port'
+    host, _, port = address.rpartition(':')
+    lines = ['{}.seconds:{:.0f}|ms'.format(prefix, metrics['seconds'] * 1000)]
+    lines.extend(
+        '{}.phase.{}:{:.0f}|ms'.format(prefix, name, seconds * 1000)
+        for name, seconds in metrics['phases'].items()
+    )
+    lines.extend(
+        '{}.bytes.{}:{}|g'.format(prefix, name, value)
+        for name, value in metrics['bytes'].items()
+    )
+    lines.append('{}.cache.{}:1|c'.format(prefix, metrics['labels'].get('cache')))
+    lines.append('{}.{}:1|c'.format(
+        prefix,
+        'success' if metrics['labels'].get('success') else 'failure',
+    ))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # Each metric is sent on its own, since a packet must not be larger
+        # than the MTU
+        for line in lines:
+            sock.sendto(line.encode(), (host, int(port)))
+    except socket.error as e:
+        logger.warning('Failed to send metrics to %s: %s', address, e)
+    finally:
+        sock.close()
+
+
+# Labels of the Prometheus metrics, the others have too many values
+PROMETHEUS_LABELS = ['cache', 'source', 'backend']
+
+
+def write_prometheus_textfile(path, prefix, metrics):
+    '''
+    Write metrics to path in the Prometheus text format, for the textfile
+    collector of the node exporter
+    '''
+    prefix = prefix.replace('.', '_')
+    labels = ','.join(
+        '{}="{}"'.format(name, metrics['labels'][name])
+        for name in PROMETHEUS_LABELS
+        if name in metrics['labels']
+    )
+    lines = [
+        '{}_timestamp_seconds {:.3f}'.format(prefix, metrics['time']),
+        '{}_seconds{{{}}} {:.3f}'.format(prefix, labels, metrics['seconds']),
+        '{}_success {}'.format(prefix, int(bool(metrics['labels'].get('success')))),
+    ]
+    lines.extend(
+        '{}_phase_seconds{{phase="{}"}} {:.3f}'.format(prefix, name, seconds)
+        for name, seconds in metrics['phases'].items()
+    )
+    lines.extend(
+        '{}_bytes{{kind="{}"}} {}'.format(prefix, name, value)
+        for name, value in metrics['bytes'].items()
+    )
+    # The collector must never read a partially written file
+    temp = make_temp_file(dir=os.path.dirname(os.path.abspath(path)))
+    with open(temp, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.chmod(temp, 0o644)
+    move_or_rename(temp, path)
+
+
+# An object in a storage backend. digest_type and digest are None when the
+# backend does not know the checksum of the object. supports_ranges is None
+# when it is the same for all objects of the backend
+StoredObject = collections.namedtuple(
+    'StoredObject',
+    ['name', 'size', 'digest_type', 'digest', 'supports_ranges'],
+)
+StoredObject.__new__.__defaults__ = (None,)
+
+
+class StorageBackend(object):
+    '''
+    A location that archives are stored in. Backends are created once per
+    Terrarium and may be used from several threads at the same time
+    '''
+    name = None
+    # Whether read_range is supported, so objects are downloaded in parallel
+    # byte ranges
+    supports_ranges = False
+    writable = True
+    max_retries = 0
+
+    def __init__(self, terrarium):
+        self.terrarium = terrarium
+        self.args = terrarium.args
+        # Seconds the last lookup took, used to prefer nearby backends
+        self.latency = 0
+        # Connections are kept per thread, since the clients are not safe to
+        # share between threads
+        self._connections = threading.local()
+
+    @classmethod
+    def is_configured(cls, args):
+        raise NotImplementedError
+
+    @property
+    def description(self):
+        return self.name
+
+    def head(self, name):
+        'Return the StoredObject of name, or None if it does not exist'
+        raise NotImplementedError
+
+    def exists(self, name):
+        return self.head(name) is not None
+
+    def open(self, name):
+        'Return a file object that streams the contents of name'
+        raise NotImplementedError
+
+    def read_range(self, name, start, end, f):
+        'Write the inclusive byte range start-end of name into f'
+        raise NotImplementedError
+
+    def put(self, local_path, name, overwrite=True):
+        'Store the file local_path as name'
+        raise NotImplementedError
+
+    def list(self, prefix=''):
+        'Return the names of the objects that start with prefix'
+        raise NotImplementedError
+
+    def get(self, obj, local_path):
+        'Download the StoredObject obj into local_path and verify it'
+        supports_ranges = obj.supports_ranges
+        if supports_ranges is None:
+            supports_ranges = self.supports_ranges
+        if supports_ranges and obj.size is not None:
+            def fetch_range(start, end, f):
+                def fetch():
+                    # A failed attempt may have written part of the range
+                    f.seek(start)
+                    self.read_range(obj.name, start, end, f)
+
+                # Only the failed range is fetched again
+                self.retry(
+                    fetch,
+                    description='download bytes {}-{} of {}'.format(
+                        start,
+                        end,
+                        obj.name,
+                    ),
+                )
+
+            download_ranges(
+                obj.size,
+                local_path,
+                fetch_range=fetch_range,
+                part_size=self.args.transfer_part_size,
+                workers=self.args.transfer_workers,
+                pool=self.terrarium._get_part_pool(),
             )
-        temp = make_temp_file(dir=storage_dir)
-        shutil.copyfile(archive, temp)
+        else:
+            f = self.open(obj.name)
+            try:
+                with open(local_path, 'wb') as dest:
+                    shutil.copyfileobj(f, dest, CHUNK_SIZE)
+            finally:
+                f.close()
+        self.verify(obj, local_path)
+
+    def verify(self, obj, local_path):
+        if obj.digest:
+            verify_checksum(local_path, obj.digest_type, obj.digest)
+        else:
+            logger.warning('Unable to verify the checksum of %s', obj.name)
+
+    def retry(self, func, description):
+        return retry_with_backoff(
+            func,
+            max_retries=self.max_retries,
+            description='{} to {}'.format(description, self.description),
+        )
+
+
+# name: storage backend class, in the order the backends are configured
+STORAGE_BACKENDS = collections.OrderedDict()
+
+
+def register_storage_backend(backend_class):
+    STORAGE_BACKENDS[backend_class.name] = backend_class
+    return backend_class
+
+
+@register_storage_backend
+class StorageDirBackend(StorageBackend):
+    name = 'storage_dir'
+    supports_ranges = True
+
+    @classmethod
+    def is_configured(cls, args):
+        return bool(args.storage_dir)
+
+    @property
+    def description(self):
+        return 'storage directory {}'.format(self.args.storage_dir)
+
+    def get_path(self, name):
+        return os.path.join(self.args.storage_dir, name)
+
+    def head(self, name):
+        path = self.get_path(name)
+        if os.path.isfile(path):
+            return StoredObject(name, os.path.getsize(path), None, None)
+
+    def open(self, name):
+        return open(self.get_path(name), 'rb')
+
+    def read_range(self, name, start, end, f):
+        with self.open(name) as src:
+            src.seek(start)
+            f.write(src.read(end - start + 1))
+
+    def get(self, obj, local_path):
+        # Linking is cheaper than copying the file in ranges
+        rmtree(local_path)
+        link_or_copy(self.get_path(obj.name), local_path)
+        self.verify(obj, local_path)
+
+    def verify(self, obj, local_path):
+        # Local files have no stored checksum, unless the caller knows it
+        if obj.digest:
+            super(StorageDirBackend, self).verify(obj, local_path)
+
+    def put(self, local_path, name, overwrite=True):
+        dest = self.get_path(name)
+        if not overwrite and os.path.exists(dest):
+            raise RuntimeError('{} already exists'.format(dest))
+        parent = os.path.dirname(dest)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        temp = make_temp_file(dir=parent)
+        shutil.copyfile(local_path, temp)
         move_or_rename(temp, dest)
-        logger.info('Archive copied to storage directory')
 
-    def upload_to_s3(self, archive):
-        logger.info('Uploading environment to S3')
-        attempts = 0
-        bucket = self._get_s3_bucket()
-        key = bucket.new_key(self.make_remote_key())
+    def list(self, prefix=''):
+        storage_dir = self.args.storage_dir
+        top = os.path.join(storage_dir, prefix.rpartition('/')[0])
+        names = []
+        for dirpath, dirnames, filenames in os.walk(top):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, storage_dir).replace(os.sep, '/')
+                if name.startswith(prefix):
+                    names.append(name)
+        return names
+
+
+@register_storage_backend
+class S3Backend(StorageBackend):
+    name = 's3'
+    supports_ranges = True
+
+    @classmethod
+    def is_configured(cls, args):
+        return bool(boto and args.s3_bucket)
+
+    @property
+    def description(self):
+        return 'S3 bucket {}'.format(self.args.s3_bucket)
+
+    @property
+    def max_retries(self):
+        return self.args.s3_max_retries
+
+    def get_bucket(self):
+        'Return the bucket, reusing the connection of this thread'
+        bucket = getattr(self._connections, 'bucket', None)
+        if bucket is None:
+            bucket = self._connect()
+            self._connections.bucket = bucket
+        return bucket
+
+    def _connect(self):
+        kwargs = {}
+        if self.args.s3_endpoint:
+            endpoint = urlparse.urlparse(self.args.s3_endpoint)
+            kwargs.update(
+                host=endpoint.hostname,
+                port=endpoint.port,
+                is_secure=endpoint.scheme == 'https',
+                calling_format=boto.s3.connection.OrdinaryCallingFormat(),
+            )
+        conn = boto.s3.connection.S3Connection(
+            aws_access_key_id=self.args.s3_access_key,
+            aws_secret_access_key=self.args.s3_secret_key,
+            **kwargs
+        )
+        return boto.s3.bucket.Bucket(conn, name=self.args.s3_bucket)
+
+    def head(self, name):
+        key = self.get_bucket().get_key(name)
+        if not key:
+            return
+        sha256 = key.get_metadata('sha256')
+        etag = key.etag.strip('"')
+        if sha256:
+            return StoredObject(name, key.size, 'sha256', sha256)
+        elif '-' not in etag:
+            # The ETag of an object uploaded in a single part is its MD5
+            return StoredObject(name, key.size, 'md5', etag)
+        return StoredObject(name, key.size, None, None)
+
+    def open(self, name):
+        # The key is read as it is downloaded
+        return boto.s3.key.Key(self.get_bucket(), name)
 
-        while True:
+    def read_range(self, name, start, end, f):
+        # Each part is fetched over the connection of its thread
+        key = boto.s3.key.Key(self.get_bucket(), name)
+        key.get_contents_to_file(
+            f,
+            headers={'Range': 'bytes={}-{}'.format(start, end)},
+        )
+
+    def put(self, local_path, name, overwrite=True):
+        size = os.path.getsize(local_path)
+        metadata = {'sha256': file_digest(local_path, 'sha256')}
+        if size <= self.args.transfer_part_size:
+            key = self.get_bucket().new_key(name)
+            key.update_metadata(metadata)
+            self.retry(
+                lambda: key.set_contents_from_filename(local_path),
+                description='upload {}'.format(name),
+            )
+        else:
+            self._put_multipart(local_path, name, size, metadata)
+
+    def _put_multipart(self, local_path, name, size, metadata):
+        multipart = self.retry(
+            lambda: self.get_bucket().initiate_multipart_upload(
+                name,
+                metadata=metadata,
+            ),
+            description='start multipart upload of {}'.format(name),
+        )
+        part_size = self.args.transfer_part_size
+        parts = [
+            (part_num, offset, min(part_size, size - offset))
+            for part_num, offset in enumerate(xrange(0, size, part_size), 1)
+        ]
+
+        def upload_part(part):
+            part_num, offset, length = part
+            # Each part is uploaded over the connection of its thread
+            upload = boto.s3.multipart.MultiPartUpload(self.get_bucket())
+            upload.key_name = multipart.key_name
+            upload.id = multipart.id
+            with open(local_path, 'rb') as f:
+                f.seek(offset)
+                upload.upload_part_from_file(f, part_num, size=length)
+
+        try:
+            # Only the failed part is retried
+            self.terrarium.map_parts(
+                lambda part: self.retry(
+                    functools.partial(upload_part, part),
+                    description='upload part {} of {} of {}'.format(
+                        part[0],
+                        len(parts),
+                        name,
+                    ),
+                ),
+                parts,
+            )
+            # The object only becomes visible once the upload is completed
+            self.retry(
+                multipart.complete_upload,
+                description='complete multipart upload of {}'.format(name),
+            )
+        except Exception:
+            multipart.cancel_upload()
+            raise
+
+    def list(self, prefix=''):
+        return [key.name for key in self.get_bucket().list(prefix=prefix)]
+
+
+@register_storage_backend
+class GCSBackend(StorageBackend):
+    name = 'gcs'
+
+    @classmethod
+    def is_configured(cls, args):
+        return bool(gcs and args.gcs_bucket)
+
+    @property
+    def description(self):
+        return 'Google Cloud Storage bucket {}'.format(self.args.gcs_bucket)
+
+    @property
+    def max_retries(self):
+        return self.args.gcs_max_retries
+
+    def get_bucket(self):
+        'Return the bucket, reusing the connection of this thread'
+        bucket = getattr(self._connections, 'bucket', None)
+        if bucket is None:
+            bucket = self._connect()
+            self._connections.bucket = bucket
+        return bucket
+
+    def _connect(self):
+        conn = gcs.get_connection(
+            self.args.gcs_project,
+            self.args.gcs_client_email,
+            self.args.gcs_private_key
+        )
+        return conn.get_bucket(self.args.gcs_bucket)
+
+    def head(self, name):
+        blob = self.get_bucket().get_key(name)
+        if not blob:
+            return
+        size = getattr(blob, 'size', None)
+        md5_hash = getattr(blob, 'md5_hash', None)
+        if md5_hash:
+            md5 = base64.b64decode(md5_hash).encode('hex')
+            return StoredObject(name, size, 'md5', md5)
+        return StoredObject(name, size, None, None)
+
+    def open(self, name):
+        # The blob can only be downloaded into a file object, so it is written
+        # into a pipe by a separate thread
+        blob = self.get_bucket().get_key(name)
+        return PipeReader(blob.download_to_file)
+
+    def get(self, obj, local_path):
+        blob = self.get_bucket().get_key(obj.name)
+        with open(local_path, 'wb') as f:
+            blob.download_to_file(f)
+        self.verify(obj, local_path)
+
+    def put(self, local_path, name, overwrite=True):
+        blob = self.get_bucket().new_key(name)
+        self.retry(
+            lambda: blob.upload_from_filename(local_path),
+            description='upload {}'.format(name),
+        )
+
+    def list(self, prefix=''):
+        return [blob.name for blob in self.get_bucket().iterator(prefix=prefix)]
+
+
+@register_storage_backend
+class HTTPBackend(StorageBackend):
+    '''
+    A read only mirror of another backend served over HTTP(S), such as a
+    caching proxy in front of a bucket
+    '''
+    name = 'http'
+    writable = False
+
+    @classmethod
+    def is_configured(cls, args):
+        return bool(args.http_mirror)
+
+    @property
+    def description(self):
+        return 'HTTP mirror {}'.format(self.args.http_mirror)
+
+    def _connect(self):
+        url = urlparse.urlparse(self.args.http_mirror)
+        if url.scheme == 'https':
+            return httplib.HTTPSConnection(url.hostname, url.port)
+        return httplib.HTTPConnection(url.hostname, url.port)
+
+    def request(self, method, name, headers=None):
+        'Send a request for name over the kept alive connection of this thread'
+        path = '{}/{}'.format(
+            urlparse.urlparse(self.args.http_mirror).path.rstrip('/'),
+            urllib.quote(name),
+        )
+        for attempt in range(2):
+            conn = getattr(self._connections, 'conn', None)
+            if conn is None:
+                conn = self._connect()
+                self._connections.conn = conn
             try:
-                key.set_contents_from_filename(archive)
-                logger.debug('upload finished')
-                return True
-            except Exception:
-                attempts = attempts + 1
-                logger.warning('There was an error uploading the file')
-                if attempts > self.args.s3_max_retries:
-                    logger.error('Attempted to upload archive to S3, but failed')
+                conn.request(method, path, headers=headers or {})
+                return conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                # The server may have closed the kept alive connection
+                conn.close()
+                self._connections.conn = None
+                if attempt:
                     raise
-                else:
-                    logger.info('Retrying S3 upload')
 
-    def upload_to_gcs(self, archive):
-        logger.info('Uploading environment to Google Cloud Storage')
-        attempts = 0
-        bucket = self._get_gcs_bucket()
-        blob = bucket.new_key(self.make_remote_key())
+    def _check_status(self, response, name, expected):
+        if response.status != expected:
+            response.read()
+            raise RuntimeError('{} returned {} {} for {}'.format(
+                self.description,
+                response.status,
+                response.reason,
+                name,
+            ))
+
+    def head(self, name):
+        response = self.request('HEAD', name)
+        response.read()
+        if response.status == 404:
+            return
+        self._check_status(response, name, 200)
+        # Depends on the server, so it is kept with the object
+        supports_ranges = response.getheader('accept-ranges') == 'bytes'
+        size = response.getheader('content-length')
+        if size is not None:
+            size = int(size)
+        # Mirrors of S3 pass on the metadata and ETag of the object
+        sha256 = response.getheader('x-amz-meta-sha256')
+        etag = (response.getheader('etag') or '').strip('"')
+        if sha256:
+            return StoredObject(name, size, 'sha256', sha256, supports_ranges)
+        elif re.match(r'^[0-9a-f]{32}$', etag):
+            return StoredObject(name, size, 'md5', etag, supports_ranges)
+        return StoredObject(name, size, None, None, supports_ranges)
+
+    def open(self, name):
+        response = self.request('GET', name)
+        self._check_status(response, name, 200)
+        return response
+
+    def read_range(self, name, start, end, f):
+        response = self.request('GET', name, headers={
+            'Range': 'bytes={}-{}'.format(start, end),
+        })
+        self._check_status(response, name, 206)
+        shutil.copyfileobj(response, f, CHUNK_SIZE)
+
+    def list(self, prefix=''):
+        '''
+        Return the names that start with prefix from the links in the index
+        page of their directory, such as the directory listing of nginx or
+        Apache
+        '''
+        directory = prefix.rpartition('/')[0]
+        if directory:
+            directory += '/'
+        response = self.request('GET', directory)
+        if response.status == 404:
+            response.read()
+            return []
+        self._check_status(response, directory, 200)
+        index = response.read()
+
+        base = urlparse.urlparse(self.args.http_mirror).path.rstrip('/') + '/'
+        directory_path = base + urllib.quote(directory)
+        names = set()
+        for href in HREF_RE.findall(index):
+            # Links to other directories or hosts are left out
+            path = urlparse.urljoin(directory_path, href)
+            if not path.startswith(directory_path) or path.endswith('/'):
+                continue
+            name = urllib.unquote(path[len(base):])
+            if name.startswith(prefix) and '/' not in name[len(directory):]:
+                names.add(name)
+        return sorted(names)
+
+
+HREF_RE = re.compile(r'''href\s*=\s*["']([^"'?#]+)''', re.IGNORECASE)
+
+
+class CountingStream(object):
+    'Count the bytes read from fileobj'
 
-        while True:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.count += len(data)
+        return data
+
+    def close(self):
+        self.fileobj.close()
+
+
+class PipeReader(object):
+    '''
+    Read the data that write(f) writes into the file object f, which is
+    called in a separate thread
+    '''
+
+    def __init__(self, write):
+        read_fd, write_fd = os.pipe()
+        self.f = os.fdopen(read_fd, 'rb')
+        self.errors = []
+
+        def run():
             try:
-                blob.upload_from_filename(archive)
-                logger.debug('upload finished')
-                return True
-            except Exception:
-                attempts = attempts + 1
-                logger.warning('There was an error uploading the file')
-                if attempts > self.args.gcs_max_retries:
-                    logger.error(
-                        'Attempted to upload archive to Google Cloud Storage, '
-                        'but failed'
-                    )
-                    raise
-                else:
-                    logger.info('Retrying Google Cloud Storage upload')
+                with os.fdopen(write_fd, 'wb') as f:
+                    write(f)
+            except Exception as e:
+                self.errors.append(e)
+
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
 
-    def upload(self, archive):
-        if self.args.storage_dir:
-            self.upload_to_storage_dir(archive, self.args.storage_dir)
-        if boto and self.args.s3_bucket:
-            self.upload_to_s3(archive)
-        if gcs and self.args.gcs_bucket:
-            self.upload_to_gcs(archive)
+    def read(self, size=-1):
+        data = self.f.read(size)
+        if not data:
+            # The writer closed the pipe, so it is done
+            self.thread.join()
+            if self.errors:
+                raise self.errors[0]
+        return data
+
+    def close(self):
+        self.f.close()
 
 
 def define_args():
@@ -313,6 +1855,50 @@ def define_args():
         dest='quiet',
         help='Silence output completely',
     )
+    ap.add_argument(
+        '--log-file',
+        default=os.environ.get('TERRARIUM_LOG_FILE', None),
+        help='''
+            Append all log messages, including the output of pip and the time
+            each command took, to this file regardless of the verbosity.
+            Defaults to TERRARIUM_LOG_FILE env variable.
+        ''',
+    )
+    ap.add_argument(
+        '--metrics-file',
+        default=os.environ.get('TERRARIUM_METRICS_FILE', None),
+        help='''
+            Append a line of JSON with the time each phase of the install
+            took, the bytes it transferred and whether the environment was
+            downloaded to this file. Defaults to TERRARIUM_METRICS_FILE env
+            variable.
+        ''',
+    )
+    ap.add_argument(
+        '--statsd-address',
+        default=os.environ.get('TERRARIUM_STATSD_ADDRESS', None),
+        help='''
+            Send the install metrics to the StatsD daemon at this host:port.
+            Defaults to TERRARIUM_STATSD_ADDRESS env variable.
+        ''',
+    )
+    ap.add_argument(
+        '--prometheus-textfile',
+        default=os.environ.get('TERRARIUM_PROMETHEUS_TEXTFILE', None),
+        help='''
+            Write the install metrics to this file in the Prometheus text
+            format, e.g. for the textfile collector of the node exporter.
+            Defaults to TERRARIUM_PROMETHEUS_TEXTFILE env variable.
+        ''',
+    )
+    ap.add_argument(
+        '--metrics-prefix',
+        default=os.environ.get('TERRARIUM_METRICS_PREFIX', 'terrarium'),
+        help='''
+            Prefix of the StatsD and Prometheus metric names. Default is
+            "terrarium".
+        ''',
+    )
     ap.add_argument(
         '-t', '--target',
         dest='target',
@@ -329,60 +1915,193 @@ def define_args():
         action='store_false',
         dest='download',
         help='''
-            If an external storage location is specified, terrarium will
-            attempt to download an existing terrarium environment instead of
-            building a new one. Using --no-download forces terrarium to build a
-            new environment.
+            If an external storage location is specified, terrarium will
+            attempt to download an existing terrarium environment instead of
+            building a new one. Using --no-download forces terrarium to build a
+            new environment.
+        ''',
+    )
+    ap.add_argument(
+        '--require-download',
+        default=False,
+        action='store_true',
+        help='''
+            If we fail to download a terrarium environment from the storage
+            location, do not proceed to build one.
+        ''',
+    )
+    ap.add_argument(
+        '--no-upload',
+        default=True,
+        action='store_false',
+        dest='upload',
+        help='''
+            If an external storage location is specified, terrarium will upload
+            a new environment after it has been built. Using --no-upload,
+            terrarium will not upload the resulting environment to the external
+            storage location.
+        ''',
+    )
+    ap.add_argument(
+        '--no-backup',
+        default=True,
+        action='store_false',
+        dest='backup',
+        help='''
+            By default, terrarium preserves the old environment. See
+            --backup-suffix. Using this option, terrarium will delete the old
+            environment.
+        ''',
+    )
+    ap.add_argument(
+        '--backup-suffix',
+        default='.bak',
+        help='''
+            The suffix to use when preserving an old environment. This option
+            is ignored if --no-backup is used. Default is .bak.
+        '''
+    )
+    ap.add_argument(
+        '--background-delete',
+        default=False,
+        action='store_true',
+        help='''
+            Instead of removing old environments, backups and temporary
+            environments during install and revert, rename them into
+            <target>.trash, and remove them in a detached terrarium gc
+            process with a low CPU and IO priority afterwards.
+        ''',
+    )
+    ap.add_argument(
+        '--generations',
+        default=False,
+        action='store_true',
+        help='''
+            Install each environment into a new directory in
+            <target>.generations, and make the target a symlink to it. The
+            symlink is replaced with a single rename once the environment is
+            complete, so the target never points at a partial environment.
+            The backup is a symlink to the previous generation, which revert
+            switches back to the same way. Older generations are removed.
+            --incremental and --delta do not apply.
+        ''',
+    )
+    ap.add_argument(
+        '--keep-generations',
+        default=2,
+        type=int,
+        help='''
+            The number of generations to keep with --generations, including
+            the one the target points at. Files that are identical to the
+            ones in the previous generation are hard linked to them by a
+            detached terrarium gc process after the install, so they are only
+            stored once. Default is 2. With --no-backup, only the
+            one the target points at is kept.
+        ''',
+    )
+    ap.add_argument(
+        '--generation',
+        type=int,
+        help='''
+            With revert, point the target at this retained generation of
+            --generations, instead of the backup.
+        ''',
+    )
+    ap.add_argument(
+        '--stream',
+        default=False,
+        action='store_true',
+        help='''
+            Extract a downloaded environment while it is being downloaded,
+            instead of saving the archive to a temporary file first.
+        ''',
+    )
+    ap.add_argument(
+        '--incremental',
+        default=False,
+        action='store_true',
+        help='''
+            Update an existing environment in place, installing and removing
+            only the packages that differ from the new environment, instead of
+            recreating it. The previous environment is still preserved as the
+            backup. See --backup-suffix.
+        ''',
+    )
+    ap.add_argument(
+        '--delta',
+        default=False,
+        action='store_true',
+        help='''
+            Record the installed environment in the target. When the target
+            already has an environment, install a delta from it to the new
+            environment in place if one was uploaded, and upload one when the
+            new environment is built. Does not apply to --dedup.
+        ''',
+    )
+    ap.add_argument(
+        '--relocatable',
+        default=False,
+        action='store_true',
+        help='''
+            Store the installed virtualenv instead of its wheels, under the
+            remote key with a .venv suffix. Installing it only extracts it
+            next to the target, moves it into place and rewrites the path it
+            was built at in its scripts and metadata. Its modules are
+            compiled in parallel with --jobs when it is built, and on install
+            only the modules whose bytecode is missing or out of date for the
+            python of the target are compiled again. The build and target
+            hosts must have python at the same location. --incremental,
+            --delta and --storage-dir-wheels do not apply, and --dedup takes
+            precedence.
         ''',
     )
     ap.add_argument(
-        '--require-download',
+        '--fast-install',
         default=False,
         action='store_true',
         help='''
-            If we fail to download a terrarium environment from the storage
-            location, do not proceed to build one.
+            Install the wheels of a new environment by unpacking them directly
+            into it, in parallel (see --jobs), instead of using pip. This is
+            safe because the wheels of an environment are already a complete
+            and resolved requirement set.
         ''',
     )
     ap.add_argument(
-        '--no-upload',
+        '--no-compress',
         default=True,
         action='store_false',
-        dest='upload',
+        dest='compress',
         help='''
-            If an external storage location is specified, terrarium will upload
-            a new environment after it has been built. Using --no-upload,
-            terrarium will not upload the resulting environment to the external
-            storage location.
+            By default, terrarium compresses the archive before uploading it.
+            See --compression.
         ''',
     )
     ap.add_argument(
-        '--no-backup',
-        default=True,
-        action='store_false',
-        dest='backup',
+        '--compression',
+        default=os.environ.get('TERRARIUM_COMPRESSION', 'gzip'),
+        choices=sorted(COMPRESSORS),
         help='''
-            By default, terrarium preserves the old environment. See
-            --backup-suffix. Using this option, terrarium will delete the old
-            environment.
+            Compression format of new archives. zstd requires that you have
+            zstandard installed and lz4 requires lz4. Archives in any of these
+            formats can be installed. Default is gzip.
         ''',
     )
     ap.add_argument(
-        '--backup-suffix',
-        default='.bak',
+        '--compression-level',
+        type=int,
+        default=None,
         help='''
-            The suffix to use when preserving an old environment. This option
-            is ignored if --no-backup is used. Default is .bak.
-        '''
+            Compression level, from fastest to smallest: 1-9 for gzip (default
+            6), 1-22 for zstd (default 3) and 0-16 for lz4 (default 0).
+        ''',
     )
     ap.add_argument(
-        '--no-compress',
-        default=True,
-        action='store_false',
-        dest='compress',
+        '--compression-threads',
+        type=int,
+        default=0,
         help='''
-            By default, terrarium compresses the archive using gzip before
-            uploading it.
+            Number of threads used to compress zstd archives. Default is one
+            per CPU.
         ''',
     )
     ap.add_argument(
@@ -394,6 +2113,65 @@ def define_args():
             shared drive.
         ''',
     )
+    ap.add_argument(
+        '--wheel-cache-dir',
+        default=os.environ.get('TERRARIUM_WHEEL_CACHE_DIR', None),
+        help='''
+            Path to a directory in which individual wheels are cached between
+            builds, keyed by requirement line, python version and
+            architecture. Only pinned requirements (name==version) are cached.
+            When building a new environment, cached wheels are reused and only
+            the missing wheels are built.
+        ''',
+    )
+    ap.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=os.environ.get('TERRARIUM_JOBS', 1),
+        help='''
+            Number of wheels to build, or install when using --fast-install,
+            in parallel. Only named requirements (not paths or URLs) are built
+            in parallel. Default is 1.
+        ''',
+    )
+    ap.add_argument(
+        '--storage-dir-wheels',
+        default=False,
+        action='store_true',
+        help='''
+            Also keep the extracted wheels of each environment in the storage
+            directory, and hard link them from there instead of extracting the
+            archive again on later installs. See --storage-dir.
+        ''',
+    )
+    ap.add_argument(
+        '--dedup',
+        default=False,
+        action='store_true',
+        help='''
+            Store environments as a manifest listing content addressed files,
+            which are shared between environments, instead of as a single
+            archive. Only the files that are missing are uploaded and
+            downloaded. See --blob-cache-dir.
+        ''',
+    )
+    ap.add_argument(
+        '--blob-cache-dir',
+        default=os.environ.get('TERRARIUM_BLOB_CACHE_DIR', None),
+        help='''
+            Path to a directory in which the files of deduplicated environments
+            are kept, so they are only downloaded once. See --dedup.
+        ''',
+    )
+    ap.add_argument(
+        '--latency-file',
+        default=os.environ.get('TERRARIUM_LATENCY_FILE', None),
+        help='''
+            Path to a file in which the time lookups in each storage location
+            took is kept between runs, so later runs rank the locations by it
+            from the start. Without it the ranking only applies within a run.
+        ''',
+    )
     ap.add_argument(
         '--digest-type',
         default='md5',
@@ -402,6 +2180,30 @@ def define_args():
     default_remote_key_format = '''
         %(arch)s-%(python_vmajor)s.%(python_vminor)s-%(digest)s
     '''.strip()
+    ap.add_argument(
+        '--canonical-digest',
+        default=False,
+        action='store_true',
+        help='''
+            Calculate the digest from a canonical form of the requirements,
+            so that the order of the requirements, comments, blank lines and
+            whitespace, and differences in case or spelling of package names
+            do not change the digest.
+        ''',
+    )
+    ap.add_argument(
+        '--resolve',
+        default=False,
+        action='store_true',
+        help='''
+            Resolve the requirements into a fully pinned set of distributions
+            with hashes, using pip download, and calculate the digest from it
+            instead. Requirement sets that resolve to the same distributions
+            share an environment. A new environment is built from the
+            downloaded distributions, and the resolved set is stored in it
+            as requirements.lock.
+        ''',
+    )
     ap.add_argument(
         '--remote-key-format',
         default=default_remote_key_format,
@@ -431,12 +2233,40 @@ def define_args():
             Defaults to S3_SECRET_KEY env variable.
         '''
     )
+    ap.add_argument(
+        '--s3-endpoint',
+        default=os.environ.get('S3_ENDPOINT', None),
+        help='''
+            URL of an S3 compatible service to use instead of Amazon S3, e.g.
+            http://localhost:9000. Defaults to S3_ENDPOINT env variable.
+        '''
+    )
     ap.add_argument(
         '--s3-max-retries',
+        type=int,
         default=os.environ.get('S3_MAX_RETRIES', 3),
         help='''
-            Number of times to attempt a S3 operation before giving up.
-            Default is 3.
+            Number of times to retry a S3 operation before giving up. Retries
+            are delayed with a randomized exponential backoff. Default is 3.
+        ''',
+    )
+
+    ap.add_argument(
+        '--transfer-part-size',
+        type=int,
+        default=os.environ.get('TERRARIUM_TRANSFER_PART_SIZE', 64 * 1024 * 1024),
+        help='''
+            Size in bytes of the parts in which archives are transferred
+            to and from S3. Archives larger than this are uploaded using a
+            multipart upload, so it must be at least 5 MiB. Default is 64 MiB.
+        ''',
+    )
+    ap.add_argument(
+        '--transfer-workers',
+        type=int,
+        default=os.environ.get('TERRARIUM_TRANSFER_WORKERS', 4),
+        help='''
+            Number of parts to transfer concurrently. Default is 4.
         ''',
     )
 
@@ -475,10 +2305,21 @@ def define_args():
     )
     ap.add_argument(
         '--gcs-max-retries',
+        type=int,
         default=os.environ.get('GCS_MAX_RETRIES', 3),
         help='''
-            Number of times to attempt a GCS operation before giving up.
-            Default is 3.
+            Number of times to retry a GCS operation before giving up. Retries
+            are delayed with a randomized exponential backoff. Default is 3.
+        '''
+    )
+
+    ap.add_argument(
+        '--http-mirror',
+        default=os.environ.get('TERRARIUM_HTTP_MIRROR', None),
+        help='''
+            URL of a read only HTTP(S) mirror to download archives from, such
+            as a caching proxy in front of a bucket. Defaults to
+            TERRARIUM_HTTP_MIRROR env variable.
         '''
     )
 
@@ -510,6 +2351,14 @@ def define_args():
                 Restore the most recent backed-up virtualenv, if it exists.
             ''',
         ),
+        'gc': subparsers.add_parser(
+            'gc',
+            help='''
+                Remove the environments that --background-delete moved to the
+                trash of the target, and share the identical files of the
+                generations of --keep-generations.
+            ''',
+        ),
     }
 
     for command in commands.values():
@@ -547,91 +2396,607 @@ def parse_args(ap):
             'which does not appear to be the case'
         )
 
+    if not zstandard and args.compression == 'zstd':
+        ap.error(
+            '--compression=zstd requires that you have zstandard installed, '
+            'which does not appear to be the case'
+        )
+
+    if args.storage_dir_wheels and not args.storage_dir:
+        ap.error('--storage-dir-wheels requires --storage-dir')
+
+    if args.transfer_part_size < MIN_TRANSFER_PART_SIZE:
+        # The smallest part S3 accepts in a multipart upload
+        ap.error('--transfer-part-size must be at least 5 MiB')
+
+    if args.transfer_workers < 1:
+        ap.error('--transfer-workers must be at least 1')
+
+    if args.keep_generations < 1:
+        ap.error('--keep-generations must be at least 1')
+
+    if not lz4 and args.compression == 'lz4':
+        ap.error(
+            '--compression=lz4 requires that you have lz4 installed, '
+            'which does not appear to be the case'
+        )
+
     return args
 
 
 def call_subprocess(command, log_level=logging.INFO):
     logger.debug('call_subprocess: %s', command)
+    start = time.time()
     process = subprocess.Popen(
         command,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
     )
 
-    while process.poll() is None:
-        while True:
-            stdout = process.stdout.readline()
-            stderr = process.stderr.readline()
-            if not stdout and not stderr:
-                break
-            stdout = stdout.strip()
-            if stdout:
-                logger.log(log_level, stdout.decode())
-            stderr = stderr.strip()
-            if stderr:
-                logger.warning(stderr.decode())
-
-    rc = process.returncode
-    if rc:
-        raise RuntimeError('{cmd} exited with code {code}'.format(
-            cmd=command[0],
-            code=rc,
-        ))
+    # Both pipes are drained at the same time, so the command never blocks
+    # writing to one of them while the other one is being read
+    threads = [
+        threading.Thread(target=log_lines, args=(process.stdout, log_level)),
+        threading.Thread(target=log_lines, args=(process.stderr, logging.WARNING)),
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    rc = process.wait()
+    logger.info(
+        '%s exited with code %s after %.1fs',
+        os.path.basename(command[0]),
+        rc,
+        time.time() - start,
+    )
+    if rc:
+        raise RuntimeError('{cmd} exited with code {code}'.format(
+            cmd=command[0],
+            code=rc,
+        ))
+
+
+def log_lines(f, level):
+    'Log each line read from f until it is closed'
+    for line in iter(f.readline, b''):
+        line = line.strip()
+        if line:
+            logger.log(level, line.decode())
+    f.close()
+
+
+def create_virtualenv(directory):
+    command = [
+        'virtualenv',
+        directory,
+    ]
+    call_subprocess(command)
+
+
+def copy_requirements(virtualenv, wheel_dir):
+    for name in ('requirements.txt', 'requirements.lock'):
+        requirements_path = os.path.join(wheel_dir, name)
+        dest = os.path.join(virtualenv, name)
+        # Replace rather than overwrite, the existing file may be hard linked
+        rmtree(dest)
+        if os.path.exists(requirements_path):
+            shutil.copyfile(requirements_path, dest)
+
+
+def pip_install_wheels(virtualenv, wheel_dir, compile=True):
+    logger.debug('pip_install_wheels: %s, %s', virtualenv, wheel_dir)
+    pip_path = os.path.join(virtualenv, 'bin', 'pip')
+
+    # Copy requirements.txt to the virtualenv
+    copy_requirements(virtualenv, wheel_dir)
+
+    # note: --find-links + --requirement
+    # the reason the command below isn't using --find-links + --requirement is
+    # because of how pip behaves when requirements.txt contains a remote source
+    # requirement. In this situation, pip ignores the wheel in the wheel_dir
+    # and instead downloads the requirement from the source
+
+    wheels = glob.glob(os.path.join(wheel_dir, '*.whl'))
+    if not wheels:
+        logger.warning('wheel directory has no wheels: %s', wheel_dir)
+        return
+
+    command = [
+        pip_path,
+        'install',
+        '--no-index',
+        '--no-cache-dir',
+    ]
+    if not compile:
+        command.append('--no-compile')
+    command.extend(wheels)
+    call_subprocess(command)
+
+
+SCRIPT_TEMPLATE = '''#!{python}
+# -*- coding: utf-8 -*-
+import re
+import sys
+
+from {module} import {import_name}
+
+if __name__ == '__main__':
+    sys.argv[0] = re.sub(r'(-script\\.pyw?|\\.exe)?$', '', sys.argv[0])
+    sys.exit({func}())
+'''
+
+
+def install_wheels(virtualenv, wheel_dir, jobs=1, compile=True):
+    '''
+    Install the wheels in wheel_dir into virtualenv by unpacking them
+    concurrently, without pip. The wheels must be a complete, resolved
+    requirement set, since dependencies are not checked.
+    '''
+    logger.debug('install_wheels: %s, %s', virtualenv, wheel_dir)
+    copy_requirements(virtualenv, wheel_dir)
+
+    wheels = glob.glob(os.path.join(wheel_dir, '*.whl'))
+    if not wheels:
+        logger.warning('wheel directory has no wheels: %s', wheel_dir)
+        return
+
+    major, minor, _ = platform.python_version_tuple()
+    python_version = 'python{}.{}'.format(major, minor)
+    site_packages = get_site_packages(virtualenv, python_version)
+    scheme = {
+        'purelib': site_packages,
+        'platlib': site_packages,
+        'scripts': os.path.join(virtualenv, 'bin'),
+        'headers': os.path.join(virtualenv, 'include', 'site', python_version),
+        'data': virtualenv,
+    }
+    python = os.path.join(virtualenv, 'bin', 'python')
+
+    installed = map_parallel(
+        lambda wheel: install_wheel(wheel, scheme, python),
+        wheels,
+        jobs,
+    )
+    logger.info('Installed %s wheels', len(wheels))
+    if not compile:
+        return
+
+    modules = [
+        path
+        for paths in installed
+        for path in paths
+        if path.endswith('.py')
+    ]
+    compile_modules(python, modules, jobs=jobs)
+
+
+def install_wheel(wheel, scheme, python):
+    '''
+    Unpack a single wheel into the directories of scheme, and write its
+    RECORD, INSTALLER and console scripts. Returns the installed paths.
+    '''
+    logger.debug('install_wheel: %s', wheel)
+    installed = []
+    with zipfile.ZipFile(wheel) as archive:
+        names = archive.namelist()
+        dist_info = next(
+            name.split('/')[0] for name in names
+            if name.split('/')[0].endswith('.dist-info')
+        )
+        data_dir = dist_info[:-len('.dist-info')] + '.data'
+        record_path = os.path.join(scheme['purelib'], dist_info, 'RECORD')
+
+        for info in archive.infolist():
+            parts = info.filename.split('/')
+            if os.path.isabs(info.filename) or os.pardir in parts:
+                raise RuntimeError(
+                    'Refusing to install {} of {} outside of the virtualenv'.format(
+                        info.filename,
+                        wheel,
+                    )
+                )
+            if info.filename.endswith('/') or info.filename == dist_info + '/RECORD':
+                continue
+            if parts[0] == data_dir:
+                key = parts[1]
+                if key == 'headers':
+                    base = os.path.join(scheme['headers'], dist_info.split('-')[0])
+                else:
+                    base = scheme[key]
+                dest = os.path.join(base, *parts[2:])
+            else:
+                dest = os.path.join(scheme['purelib'], *parts)
+
+            data = archive.read(info)
+            mode = info.external_attr >> 16
+            if parts[0] == data_dir and parts[1] == 'scripts':
+                if data.startswith(b'#!python'):
+                    data = b'#!' + python + data[len(b'#!python'):]
+                mode = 0o755
+            write_file(dest, data, mode & 0o777)
+            installed.append(dest)
+
+        entry_points = dist_info + '/entry_points.txt'
+        if entry_points in names:
+            for path, data in get_entry_point_scripts(
+                archive.read(entry_points),
+                scheme['scripts'],
+                python,
+            ):
+                write_file(path, data, 0o755)
+                installed.append(path)
+
+    installer_path = os.path.join(scheme['purelib'], dist_info, 'INSTALLER')
+    write_file(installer_path, b'terrarium\n')
+    installed.append(installer_path)
+    write_record(record_path, installed, scheme['purelib'])
+    return installed
+
+
+def get_entry_point_scripts(entry_points, scripts_dir, python):
+    'Yield (path, contents) of the console scripts defined by entry_points'
+    parser = ConfigParser.RawConfigParser()
+    parser.optionxform = str
+    parser.readfp(io.BytesIO(entry_points))
+    for section in ('console_scripts', 'gui_scripts'):
+        if not parser.has_section(section):
+            continue
+        for name, value in parser.items(section):
+            if os.path.basename(name) != name or name in (os.curdir, os.pardir):
+                raise RuntimeError(
+                    'Refusing to install script {} outside of {}'.format(
+                        name,
+                        scripts_dir,
+                    )
+                )
+            # e.g. "module.name:func.attr [extra]"
+            module, _, func = value.split('[')[0].strip().partition(':')
+            contents = SCRIPT_TEMPLATE.format(
+                python=python,
+                module=module,
+                import_name=func.split('.')[0],
+                func=func,
+            )
+            yield os.path.join(scripts_dir, name), contents
+
+
+def write_record(record_path, installed, site_packages):
+    with open(record_path, 'wb') as f:
+        writer = csv.writer(f)
+        for path in installed:
+            with open(path, 'rb') as installed_file:
+                data = installed_file.read()
+            digest = base64.urlsafe_b64encode(hashlib.sha256(data).digest())
+            writer.writerow([
+                os.path.relpath(path, site_packages),
+                'sha256={}'.format(digest.rstrip(b'=')),
+                len(data),
+            ])
+        writer.writerow([os.path.relpath(record_path, site_packages), '', ''])
+
+
+def write_file(path, data, mode=None):
+    'Replace the file at path, so concurrent readers see either version'
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Created by another thread in the meantime
+            if not os.path.isdir(directory):
+                raise
+    fd, temp = tempfile.mkstemp(prefix='.terrarium-', dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    if mode:
+        os.chmod(temp, mode)
+    else:
+        os.chmod(temp, 0o644)
+    os.rename(temp, path)
+
+
+def compile_modules(python, modules, jobs=1):
+    '''
+    Compile modules to bytecode with python, in parallel. Modules whose
+    bytecode is up to date for python are skipped.
+    '''
+    if not modules:
+        return
+    jobs = max(1, min(jobs, len(modules)))
+    batches = [modules[i::jobs] for i in xrange(jobs)]
+
+    def compile_batch(batch):
+        list_path = make_temp_file(suffix='.txt')
+        try:
+            with open(list_path, 'w') as f:
+                f.writelines('{}\n'.format(path) for path in batch)
+            call_subprocess(
+                [python, '-m', 'compileall', '-q', '-i', list_path],
+                log_level=logging.DEBUG,
+            )
+        except RuntimeError:
+            # Like pip, ignore modules that fail to compile, such as
+            # modules for other python versions
+            logger.debug('Some modules failed to compile')
+        finally:
+            rmtree(list_path)
+
+    map_parallel(compile_batch, batches, jobs)
+
+
+def compile_virtualenv(virtualenv, jobs=1):
+    '''
+    Compile all modules installed in virtualenv to bytecode, in parallel.
+    See compile_modules.
+    '''
+    modules = [
+        os.path.join(dirpath, name)
+        for site_packages in glob.glob(get_site_packages(virtualenv))
+        for dirpath, _, filenames in os.walk(site_packages)
+        for name in filenames
+        if name.endswith('.py')
+    ]
+    logger.info('Compiling %s modules', len(modules))
+    compile_modules(
+        os.path.join(virtualenv, 'bin', 'python'),
+        modules,
+        jobs=jobs,
+    )
+
+
+def verify_bytecode(virtualenv, jobs=1):
+    '''
+    Compile the modules of virtualenv whose shipped bytecode is missing, or
+    does not match the module or the python of virtualenv. Bytecode that is
+    up to date is kept after a relocation, python replaces the path it
+    records when the module is imported.
+    '''
+    logger.debug('Verifying the bytecode of %s', virtualenv)
+    compile_virtualenv(virtualenv, jobs=jobs)
+
+
+# Distributions installed by virtualenv itself
+VIRTUALENV_DISTRIBUTIONS = frozenset(['pip', 'setuptools', 'wheel'])
+
+
+def is_virtualenv(path):
+    major, minor, _ = platform.python_version_tuple()
+    return os.path.isfile(os.path.join(path, 'bin', 'python')) and os.path.isdir(
+        get_site_packages(path, 'python{}.{}'.format(major, minor))
+    )
+
+
+def get_site_packages(virtualenv, python='python*'):
+    return os.path.join(virtualenv, 'lib', python, 'site-packages')
+
+
+def get_installed_distributions(virtualenv):
+    'Return a {name: version} mapping of the distributions in virtualenv'
+    installed = {}
+    for pattern in ('*.dist-info', '*.egg-info'):
+        metadata_dirs = glob.glob(os.path.join(
+            get_site_packages(virtualenv),
+            pattern,
+        ))
+        for path in metadata_dirs:
+            basename = os.path.splitext(os.path.basename(path))[0]
+            name, version = basename.split('-')[:2]
+            installed[canonicalize_name(name)] = version
+    return installed
+
+
+def get_wheel_digests(wheel_dir):
+    'Return a {filename: sha256} mapping of the wheels in wheel_dir'
+    return dict(
+        (os.path.basename(wheel), file_digest(wheel, 'sha256'))
+        for wheel in glob.glob(os.path.join(wheel_dir, '*.whl'))
+    )
+
+
+ENVIRONMENT_INFO_NAME = '.terrarium.json'
+DELTA_INFO_NAME = 'delta.json'
+
+
+def read_environment_info(virtualenv):
+    path = os.path.join(virtualenv, ENVIRONMENT_INFO_NAME)
+    if not os.path.exists(path):
+        return
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_environment_info(virtualenv, info):
+    write_file(
+        os.path.join(virtualenv, ENVIRONMENT_INFO_NAME),
+        json.dumps(info, indent=2, sort_keys=True),
+    )
+
+
+def relocate_virtualenv(virtualenv):
+    '''
+    Replace the path that virtualenv was built at with its current path in
+    its scripts, activate scripts, .pth files, package metadata and symlinks
+    '''
+    info = read_environment_info(virtualenv)
+    if not info or 'prefix' not in info:
+        raise RuntimeError(
+            '{} was not built with --relocatable'.format(virtualenv),
+        )
+    old_prefix = info['prefix']
+    new_prefix = os.path.abspath(virtualenv)
+    if old_prefix == new_prefix:
+        return
+    logger.info('Relocating virtualenv from %s to %s', old_prefix, new_prefix)
+    # Only whole paths, so /env is not replaced in /env2
+    pattern = re.compile(
+        re.escape(old_prefix) + r'(?=[/\s"\':]|$)',
+        re.MULTILINE,
+    )
+    bin_dir = os.path.join(virtualenv, 'bin')
+
+    for dirpath, dirnames, filenames in os.walk(virtualenv):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                link = os.readlink(path)
+                if pattern.match(link):
+                    os.remove(path)
+                    os.symlink(pattern.sub(new_prefix, link, count=1), path)
+            elif name in filenames and (
+                dirpath == bin_dir or name.endswith(RELOCATED_FILE_SUFFIXES)
+            ):
+                relocate_file(path, pattern, new_prefix)
+
+    info['prefix'] = new_prefix
+    write_environment_info(virtualenv, info)
+
+
+# Files outside of bin/ that may refer to the path of the virtualenv
+RELOCATED_FILE_SUFFIXES = (
+    '.pth',
+    '.egg-link',
+    'RECORD',
+    'installed-files.txt',
+    'direct_url.json',
+)
+
+
+def relocate_file(path, pattern, new_prefix):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if b'\0' in data[:CHUNK_SIZE]:
+        # Binaries are left alone, the prefix can not be replaced in place
+        return
+    relocated = pattern.sub(new_prefix.replace('\\', '\\\\'), data)
+    if relocated != data:
+        write_file(path, relocated, mode=os.stat(path).st_mode & 0o7777)
+
+
+def read_delta_info(delta_dir):
+    with open(os.path.join(delta_dir, DELTA_INFO_NAME)) as f:
+        return json.load(f)
+
+
+def pip_sync_wheels(virtualenv, wheel_dir):
+    '''
+    Make the distributions installed in an existing virtualenv match the wheels
+    in wheel_dir, by removing and installing only what differs
+    '''
+    logger.debug('pip_sync_wheels: %s, %s', virtualenv, wheel_dir)
+    copy_requirements(virtualenv, wheel_dir)
 
+    wheels = {}
+    for wheel in glob.glob(os.path.join(wheel_dir, '*.whl')):
+        name, version = parse_wheel_filename(wheel)
+        wheels[name] = (version, wheel)
+    installed = get_installed_distributions(virtualenv)
 
-def create_virtualenv(directory):
-    command = [
-        'virtualenv',
-        directory,
-    ]
-    call_subprocess(command)
+    remove = sorted(
+        name for name in installed
+        if name not in wheels and name not in VIRTUALENV_DISTRIBUTIONS
+    )
+    install = sorted(
+        wheel for name, (version, wheel) in wheels.items()
+        if installed.get(name) != version
+    )
+    logger.info(
+        'Removing %s and installing %s of %s distributions',
+        len(remove),
+        len(install),
+        len(wheels),
+    )
+    pip_update_distributions(virtualenv, remove, install)
 
 
-def pip_install_wheels(virtualenv, wheel_dir):
-    logger.debug('pip_install_wheels: %s, %s', virtualenv, wheel_dir)
-    pip_path = os.path.join(virtualenv, 'bin', 'pip')
-    requirements_path = os.path.join(wheel_dir, 'requirements.txt')
+def pip_apply_delta(virtualenv, delta_dir):
+    '''
+    Apply a delta to the environment it was made from, removing and installing
+    the distributions it lists
+    '''
+    logger.debug('pip_apply_delta: %s, %s', virtualenv, delta_dir)
+    copy_requirements(virtualenv, delta_dir)
 
-    # Copy requirements.txt to the virtualenv
-    shutil.copyfile(
-        requirements_path,
-        os.path.join(virtualenv, 'requirements.txt'),
+    delta = read_delta_info(delta_dir)
+    install = sorted(glob.glob(os.path.join(delta_dir, '*.whl')))
+    logger.info(
+        'Removing %s and installing %s of %s distributions',
+        len(delta['remove']),
+        len(install),
+        len(delta['wheels']),
+    )
+    # The wheels of a delta may have been rebuilt with the same version
+    pip_update_distributions(
+        virtualenv,
+        delta['remove'],
+        install,
+        force_reinstall=True,
     )
 
-    # note: --find-links + --requirement
-    # the reason the command below isn't using --find-links + --requirement is
-    # because of how pip behaves when requirements.txt contains a remote source
-    # requirement. In this situation, pip ignores the wheel in the wheel_dir
-    # and instead downloads the requirement from the source
 
-    wheels = glob.glob(os.path.join(wheel_dir, '*.whl'))
-    if not wheels:
-        logger.warning('wheel directory has no wheels: %s', wheel_dir)
-        return
+def pip_update_distributions(virtualenv, remove, install, force_reinstall=False):
+    pip_path = os.path.join(virtualenv, 'bin', 'pip')
 
-    command = [
-        pip_path,
-        'install',
-        '--no-index',
-        '--no-cache-dir',
-    ]
-    command.extend(wheels)
-    call_subprocess(command)
+    if remove:
+        command = [
+            pip_path,
+            'uninstall',
+            '--yes',
+        ]
+        command.extend(remove)
+        call_subprocess(command)
 
+    if install:
+        # Changed versions are replaced by pip. Dependencies are not resolved,
+        # the wheel directory already contains the complete requirement set
+        command = [
+            pip_path,
+            'install',
+            '--no-index',
+            '--no-cache-dir',
+            '--no-deps',
+        ]
+        if force_reinstall:
+            command.append('--force-reinstall')
+        command.extend(install)
+        call_subprocess(command)
 
-def install_environment(local_archive_path, local_directory):
-    logger.debug('install_environment: %s, %s', local_archive_path, local_directory)
-    wheel_dir = tempfile.mkdtemp(prefix='terrarium-wheel-')
-    extract_tar_archive(local_archive_path, wheel_dir)
+
+def install_wheel_dir(
+    wheel_dir,
+    local_directory,
+    incremental=False,
+    fast=False,
+    jobs=1,
+    metrics=None,
+    compile=True,
+):
+    logger.debug('install_wheel_dir: %s, %s', wheel_dir, local_directory)
     requirements_path = os.path.join(wheel_dir, 'requirements.txt')
     if not os.path.exists(requirements_path):
         raise RuntimeError('Environment is missing requirements.txt')
+    if metrics is None:
+        metrics = Metrics()
 
-    create_virtualenv(local_directory)
-    pip_install_wheels(local_directory, wheel_dir)
+    if not incremental:
+        with metrics.phase('virtualenv'):
+            create_virtualenv(local_directory)
+    with metrics.phase('install'):
+        if incremental:
+            pip_sync_wheels(local_directory, wheel_dir)
+        elif fast:
+            install_wheels(
+                local_directory,
+                wheel_dir,
+                jobs=jobs,
+                compile=compile,
+            )
+        else:
+            pip_install_wheels(local_directory, wheel_dir, compile=compile)
 
 
-def pip_wheel(wheel_dir, requirements):
+def pip_wheel(wheel_dir, requirements, wheel_cache_dir=None, jobs=1):
     requirements_path = os.path.join(wheel_dir, 'requirements.txt')
     with open(requirements_path, 'w') as f:
         f.write(flatten_requirements(requirements))
@@ -640,9 +3005,194 @@ def pip_wheel(wheel_dir, requirements):
         'pip',
         'wheel',
         '--wheel-dir', wheel_dir,
-        '--requirement', requirements_path,
     ]
-    call_subprocess(command)
+
+    # pip picks the wheels in here up instead of building them
+    links_dir = tempfile.mkdtemp(prefix='terrarium-wheel-links-')
+    cached = set()
+    try:
+        if wheel_cache_dir:
+            cached = restore_cached_wheels(wheel_cache_dir, requirements, links_dir)
+        if jobs > 1:
+            pip_wheel_parallel(
+                links_dir,
+                [line for line in requirements if line not in cached],
+                jobs=jobs,
+            )
+        # Resolve the complete requirement set, which also builds any
+        # requirement that could not be built in parallel
+        command.extend(['--find-links', links_dir])
+        command.extend(['--requirement', requirements_path])
+        call_subprocess(command)
+    finally:
+        rmtree(links_dir)
+
+    if wheel_cache_dir:
+        store_cached_wheels(
+            wheel_cache_dir,
+            [line for line in requirements if line not in cached],
+            wheel_dir,
+        )
+
+
+def pip_wheel_parallel(wheel_dir, requirements, jobs):
+    '''
+    Build a wheel for each named requirement (e.g. "lxml==4.3.0", but not paths
+    or URLs) concurrently, without their dependencies, into wheel_dir
+    '''
+    options = [line for line in requirements if is_option_line(line)]
+    named = [line for line in requirements if is_named_requirement(line)]
+    logger.info(
+        'Building %s wheels with %s parallel jobs',
+        len(named),
+        jobs,
+    )
+
+    def build(line):
+        build_dir = tempfile.mkdtemp(prefix='terrarium-wheel-build-')
+        try:
+            # Options such as --index-url apply to each build
+            requirements_path = os.path.join(build_dir, 'requirements.txt')
+            with open(requirements_path, 'w') as f:
+                f.write(flatten_requirements(options + [line]))
+            call_subprocess([
+                'pip',
+                'wheel',
+                '--no-deps',
+                '--wheel-dir', build_dir,
+                '--requirement', requirements_path,
+            ])
+            for wheel in glob.glob(os.path.join(build_dir, '*.whl')):
+                dest = os.path.join(wheel_dir, os.path.basename(wheel))
+                if not os.path.exists(dest):
+                    move_or_rename(wheel, dest)
+        finally:
+            rmtree(build_dir)
+
+    # The builds themselves run in pip subprocesses
+    map_parallel(build, named, jobs)
+
+
+def canonicalize_name(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+INLINE_COMMENT_RE = re.compile(r'(^|\s+)#.*$')
+
+PINNED_REQUIREMENT_RE = re.compile(r'''
+    ^(?P<name>[A-Za-z0-9][A-Za-z0-9._-]*)
+    \s*(?:\[[^\]]*\])?
+    \s*===?\s*(?P<version>[^\s;,]+)
+    \s*(?:;.*)?$
+''', re.VERBOSE)
+
+
+NAMED_REQUIREMENT_RE = re.compile(r'''
+    ^[A-Za-z0-9][A-Za-z0-9._-]*
+    \s*(?:\[[^\]]*\])?
+    \s*(?:[<>=!~;].*)?$
+''', re.VERBOSE)
+
+
+def is_named_requirement(line):
+    'Whether line names a requirement, instead of a path, URL or option'
+    line = INLINE_COMMENT_RE.sub('', line).strip()
+    return bool(NAMED_REQUIREMENT_RE.match(line))
+
+
+def is_option_line(line):
+    'Whether line is a global option, such as --index-url'
+    return line.startswith('-') and not line.startswith(('-e', '--editable'))
+
+
+def parse_pinned_requirement(line):
+    '''
+    Return (name, version) for a requirement pinned to an exact version, such
+    as "Django==1.11.20", otherwise None
+    '''
+    line = INLINE_COMMENT_RE.sub('', line).strip()
+    match = PINNED_REQUIREMENT_RE.match(line)
+    if not match:
+        return None
+    return canonicalize_name(match.group('name')), match.group('version')
+
+
+def parse_wheel_filename(path):
+    'Return (name, version) for the given wheel filename'
+    name, version = os.path.basename(path).split('-')[:2]
+    return canonicalize_name(name), version
+
+
+def make_wheel_cache_key(line):
+    major, minor, _ = platform.python_version_tuple()
+    h = hashlib.sha256()
+    h.update('\n'.join([
+        INLINE_COMMENT_RE.sub('', line).strip(),
+        '{}.{}'.format(major, minor),
+        sys.platform,
+        platform.machine(),
+    ]))
+    return h.hexdigest()
+
+
+def get_wheel_cache_path(wheel_cache_dir, line):
+    key = make_wheel_cache_key(line)
+    return os.path.join(wheel_cache_dir, key[:2], key)
+
+
+def restore_cached_wheels(wheel_cache_dir, requirements, wheel_dir):
+    '''
+    Link the cached wheel for each pinned requirement into wheel_dir.
+    Returns the set of requirement lines that were found in the cache.
+    '''
+    cached = set()
+    for line in requirements:
+        if not parse_pinned_requirement(line):
+            continue
+        wheels = glob.glob(os.path.join(
+            get_wheel_cache_path(wheel_cache_dir, line),
+            '*.whl',
+        ))
+        if not wheels:
+            continue
+        for wheel in wheels:
+            link_or_copy(wheel, os.path.join(wheel_dir, os.path.basename(wheel)))
+        cached.add(line)
+    logger.info(
+        'Found %s of %s requirements in the wheel cache',
+        len(cached),
+        len(requirements),
+    )
+    return cached
+
+
+def store_cached_wheels(wheel_cache_dir, requirements, wheel_dir):
+    'Store the wheel built for each pinned requirement in the wheel cache'
+    wheels = {}
+    for wheel in glob.glob(os.path.join(wheel_dir, '*.whl')):
+        wheels[parse_wheel_filename(wheel)] = wheel
+
+    for line in requirements:
+        pinned = parse_pinned_requirement(line)
+        if not pinned or pinned not in wheels:
+            continue
+        dest = get_wheel_cache_path(wheel_cache_dir, line)
+        if os.path.exists(dest):
+            continue
+        parent = os.path.dirname(dest)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        # Populate a temporary directory first, so that concurrent builds
+        # never see a partially written cache entry
+        temp = tempfile.mkdtemp(prefix='terrarium-', dir=parent)
+        wheel = wheels[pinned]
+        link_or_copy(wheel, os.path.join(temp, os.path.basename(wheel)))
+        try:
+            os.rename(temp, dest)
+        except OSError:
+            # Another build stored the same wheel first
+            rmtree(temp)
+        logger.debug('Cached %s in %s', os.path.basename(wheel), dest)
 
 
 def flatten_requirements(requirements):
@@ -651,39 +3201,326 @@ def flatten_requirements(requirements):
     return '\n'.join(requirements) + '\n'
 
 
-def create_environment(requirements, compress=True):
+def create_environment(
+    requirements,
+    compress=True,
+    wheel_cache_dir=None,
+    jobs=1,
+    compression='gzip',
+    compression_level=None,
+    compression_threads=0,
+    locked_requirements=None,
+    download_dir=None,
+):
     logger.debug('create_environment')
+    wheel_dir = build_wheels(
+        requirements,
+        wheel_cache_dir=wheel_cache_dir,
+        jobs=jobs,
+        locked_requirements=locked_requirements,
+        download_dir=download_dir,
+    )
+    archive_path = create_tar_archive(
+        wheel_dir,
+        compression=compression if compress else None,
+        compression_level=compression_level,
+        compression_threads=compression_threads,
+    )
+    return archive_path
+
+
+def build_wheels(
+    requirements,
+    wheel_cache_dir=None,
+    jobs=1,
+    locked_requirements=None,
+    download_dir=None,
+):
+    '''
+    Build the wheels of requirements into a new directory and return it.
+    With locked_requirements, exactly those are built, from the distributions
+    that resolve_requirements downloaded into download_dir when given.
+    '''
     wheel_dir = tempfile.mkdtemp(prefix='terrarium-wheel-')
-    pip_wheel(wheel_dir, requirements)
-    archive_path = create_tar_archive(wheel_dir)
-    if not compress:
-        return archive_path
-    compressed_archive_path = gzip_compress(archive_path)
-    return compressed_archive_path
+    if locked_requirements:
+        # Build exactly the resolved set, the archive is keyed by it. The
+        # hashes are checked here rather than by pip, which can not check
+        # paths and URLs, and the pinned lines match the wheel cache.
+        lines = [line.split(' --hash=')[0] for line in locked_requirements]
+        if download_dir:
+            verify_locked_downloads(locked_requirements, download_dir)
+            # Only the checked downloads can be built, without fetching
+            # them again
+            lines = ['--no-index', '--find-links {}'.format(download_dir)] + lines
+        pip_wheel(
+            wheel_dir,
+            lines,
+            wheel_cache_dir=wheel_cache_dir,
+            jobs=jobs,
+        )
+        with open(os.path.join(wheel_dir, 'requirements.txt'), 'w') as f:
+            f.write(flatten_requirements(requirements))
+        with open(os.path.join(wheel_dir, 'requirements.lock'), 'w') as f:
+            f.write(flatten_requirements(locked_requirements))
+    else:
+        pip_wheel(
+            wheel_dir,
+            requirements,
+            wheel_cache_dir=wheel_cache_dir,
+            jobs=jobs,
+        )
+    return wheel_dir
 
 
-def calculate_digest_for_requirements(digest_type, requirements):
+def calculate_digest_for_requirements(digest_type, requirements, canonical=False):
+    if canonical:
+        requirements = canonicalize_requirements(requirements)
     h = hashlib.new(digest_type)
     h.update(flatten_requirements(requirements))
     return h.hexdigest()
 
 
-def gzip_compress(target):
-    call_subprocess(['gzip', '--force', target])
-    return '{}.gz'.format(target)
+def resolve_requirements(requirements, download_dir):
+    '''
+    Resolve requirements into the fully pinned set of distributions they
+    install, e.g. "six==1.12.0 --hash=sha256:...". Options and requirements
+    that are not named (paths and URLs) are kept as they are. The
+    distributions are downloaded into download_dir, to build them from.
+    '''
+    logger.debug('resolve_requirements')
+    requirements_path = make_temp_file(suffix='.txt')
+    try:
+        with open(requirements_path, 'w') as f:
+            f.write(flatten_requirements(requirements))
+        call_subprocess([
+            'pip',
+            'download',
+            '--dest', download_dir,
+            '--requirement', requirements_path,
+        ])
 
+        options = []
+        unnamed = []
+        unnamed_names = set()
+        for line in requirements:
+            line = ' '.join(INLINE_COMMENT_RE.sub('', line).split())
+            if not line or is_named_requirement(line):
+                continue
+            if is_option_line(line):
+                options.append(line)
+            else:
+                unnamed.append(line)
+                egg = re.search(r'#egg=([^&\s]+)', line)
+                if egg:
+                    unnamed_names.add(canonicalize_name(egg.group(1)))
 
-def create_tar_archive(directory):
-    logger.debug('create_tar_archive: %s', directory)
-    archive_path = make_temp_file(suffix='.tar')
-    command = [
-        'tar',
-        '--create',
-        '--file', archive_path,
-        '--directory', directory,
-        '.'
-    ]
-    call_subprocess(command)
+        pinned = []
+        for name in os.listdir(download_dir):
+            path = os.path.join(download_dir, name)
+            name, version = parse_distribution_filename(path)
+            if name in unnamed_names:
+                # Exported from version control, rather than resolved
+                continue
+            pinned.append('{}=={} --hash=sha256:{}'.format(
+                name,
+                version,
+                file_digest(path, 'sha256'),
+            ))
+    finally:
+        rmtree(requirements_path)
+
+    # Paths and URLs may depend on the pinned requirements, so they come last
+    return options + sorted(pinned) + unnamed
+
+
+def verify_locked_downloads(locked_requirements, download_dir):
+    '''
+    Check that download_dir has the distribution of each pinned line of
+    locked_requirements, with the hash that the line lists
+    '''
+    paths = {}
+    for name in os.listdir(download_dir):
+        path = os.path.join(download_dir, name)
+        paths[parse_distribution_filename(path)] = path
+    for line in locked_requirements:
+        requirement, _, digest = line.partition(' --hash=sha256:')
+        if not digest:
+            continue
+        path = paths.get(parse_pinned_requirement(requirement))
+        if not path or file_digest(path, 'sha256') != digest:
+            raise RuntimeError(
+                'The download of {} does not match the locked requirements'.format(
+                    requirement,
+                )
+            )
+
+
+SDIST_EXTENSIONS = ('.tar.gz', '.tar.bz2', '.tgz', '.zip')
+
+
+def parse_distribution_filename(path):
+    'Return (name, version) for the given wheel or sdist filename'
+    if path.endswith('.whl'):
+        return parse_wheel_filename(path)
+    basename = os.path.basename(path)
+    for extension in SDIST_EXTENSIONS:
+        if basename.endswith(extension):
+            basename = basename[:-len(extension)]
+            break
+    name, version = basename.rsplit('-', 1)
+    return canonicalize_name(name), version
+
+
+REQUIREMENT_RE = re.compile(r'''
+    ^(?P<name>[A-Za-z0-9][A-Za-z0-9._-]*)
+    \s*(?:\[(?P<extras>[^\]]*)\])?
+    \s*(?P<specifiers>[^;]*?)
+    \s*(?:;\s*(?P<markers>.*))?$
+''', re.VERBOSE)
+
+SPECIFIER_RE = re.compile(r'^\s*(~=|===|==|!=|<=|>=|<|>)\s*([^\s,]+)\s*$')
+
+
+def canonicalize_requirement(line):
+    '''
+    Return a normalized form of a requirement line, in which names are
+    normalized and lowercased, extras and version specifiers are sorted, and
+    comments and insignificant whitespace are removed
+    '''
+    line = INLINE_COMMENT_RE.sub('', line).strip()
+    match = REQUIREMENT_RE.match(line)
+    specifiers = []
+    if match and match.group('specifiers'):
+        specifiers = [
+            SPECIFIER_RE.match(specifier)
+            for specifier in match.group('specifiers').split(',')
+        ]
+    if not match or not all(specifiers):
+        # Paths, URLs and options are only normalized for whitespace
+        return ' '.join(line.split())
+
+    canonical = canonicalize_name(match.group('name'))
+    if match.group('extras'):
+        extras = set(
+            canonicalize_name(extra.strip())
+            for extra in match.group('extras').split(',')
+            if extra.strip()
+        )
+        canonical += '[{}]'.format(','.join(sorted(extras)))
+    canonical += ','.join(sorted(
+        ''.join(specifier.groups())
+        for specifier in specifiers
+    ))
+    if match.group('markers'):
+        canonical += '; {}'.format(' '.join(match.group('markers').split()))
+    return canonical
+
+
+def canonicalize_requirements(requirements):
+    '''
+    Return the sorted, unique, canonical forms of requirements, without blank
+    lines and comments
+    '''
+    canonical = set()
+    for line in requirements:
+        line = canonicalize_requirement(line)
+        if line:
+            canonical.add(line)
+    return sorted(canonical)
+
+
+class CompressingWriter(object):
+    'Write the output of a compression object, such as zlib.compressobj()'
+
+    def __init__(self, path, compressobj):
+        self.f = open(path, 'wb')
+        self.compressobj = compressobj
+
+    def write(self, data):
+        compressed = self.compressobj.compress(data)
+        if compressed:
+            self.f.write(compressed)
+
+    def close(self):
+        self.f.write(self.compressobj.flush())
+        self.f.close()
+
+
+def open_gzip_writer(path, level=None, threads=None):
+    if level is None:
+        level = 6
+    return gzip.GzipFile(path, 'wb', compresslevel=level)
+
+
+def open_zstd_writer(path, level=None, threads=None):
+    if level is None:
+        level = 3
+    if not threads:
+        threads = multiprocessing.cpu_count()
+    compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+    return CompressingWriter(path, compressor.compressobj())
+
+
+def open_lz4_writer(path, level=None, threads=None):
+    if level is None:
+        level = 0
+    return lz4.frame.open(path, 'wb', compression_level=level)
+
+
+# compression: (file suffix, open a file for writing compressed data)
+COMPRESSORS = {
+    'gzip': ('.gz', open_gzip_writer),
+    'zstd': ('.zst', open_zstd_writer),
+    'lz4': ('.lz4', open_lz4_writer),
+}
+
+
+def compress_file(target, compression, level=None, threads=None):
+    'Compress target into a new file with the suffix of compression'
+    suffix, open_writer = COMPRESSORS[compression]
+    compressed = '{}{}'.format(target, suffix)
+    with open(target, 'rb') as src:
+        dst = open_writer(compressed, level=level, threads=threads)
+        try:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        finally:
+            dst.close()
+    os.unlink(target)
+    return compressed
+
+
+def gzip_compress(target, level=None):
+    return compress_file(target, 'gzip', level=level)
+
+
+def create_tar_archive(
+    directory,
+    compression=None,
+    compression_level=None,
+    compression_threads=0,
+):
+    '''
+    Archive the contents of directory, compressing the archive as it is
+    written when a compression is given
+    '''
+    logger.debug('create_tar_archive: %s, %s', directory, compression)
+    if compression:
+        suffix, open_writer = COMPRESSORS[compression]
+        archive_path = make_temp_file(suffix='.tar' + suffix)
+        fileobj = open_writer(
+            archive_path,
+            level=compression_level,
+            threads=compression_threads,
+        )
+    else:
+        archive_path = make_temp_file(suffix='.tar')
+        fileobj = open(archive_path, 'wb')
+    try:
+        with tarfile.open(fileobj=fileobj, mode='w|') as archive:
+            for name in sorted(os.listdir(directory)):
+                archive.add(os.path.join(directory, name), arcname=name)
+    finally:
+        fileobj.close()
     return archive_path
 
 
@@ -694,9 +3531,95 @@ MAGIC_NUM = {
     'GZIP': ('\x1f\x8b', 0),
     'BZIP': ('\x42\x5a', 0),
     'TAR': ('ustar', 257),
+    'ZSTD': ('\x28\xb5\x2f\xfd', 0),
+    'LZ4': ('\x04\x22\x4d\x18', 0),
+}
+
+
+def get_zstd_decompressor():
+    if not zstandard:
+        raise RuntimeError(
+            'Extracting a zstd archive requires that you have zstandard '
+            'installed, which does not appear to be the case'
+        )
+    return zstandard.ZstdDecompressor().decompressobj().decompress
+
+
+def get_lz4_decompressor():
+    if not lz4:
+        raise RuntimeError(
+            'Extracting a lz4 archive requires that you have lz4 installed, '
+            'which does not appear to be the case'
+        )
+    return lz4.frame.LZ4FrameDecompressor().decompress
+
+
+# Compression formats tarfile can not read by itself
+STREAM_DECOMPRESSORS = {
+    'ZSTD': get_zstd_decompressor,
+    'LZ4': get_lz4_decompressor,
 }
 
 
+class PrefixedStream(object):
+    'Read the bytes in prefix, followed by the rest of fileobj'
+
+    def __init__(self, prefix, fileobj):
+        self.prefix = prefix
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.fileobj.read(size)
+        if size < 0:
+            data = self.prefix + self.fileobj.read()
+        elif size <= len(self.prefix):
+            data = self.prefix[:size]
+        else:
+            data = self.prefix + self.fileobj.read(size - len(self.prefix))
+        self.prefix = self.prefix[len(data):]
+        return data
+
+
+class DecompressingStream(object):
+    'Read the output of decompress(chunk) for the chunks of fileobj'
+
+    def __init__(self, fileobj, decompress):
+        self.fileobj = fileobj
+        self.decompress = decompress
+        self.buffer = b''
+        self.offset = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.offset < size:
+            chunk = self.fileobj.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            self.buffer = self.buffer[self.offset:] + self.decompress(chunk)
+            self.offset = 0
+        if size < 0:
+            size = len(self.buffer) - self.offset
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+
+def open_decompressed_stream(fileobj):
+    '''
+    Detect the compression of the stream fileobj, and return a stream that is
+    readable by tarfile
+    '''
+    prefix = fileobj.read(max(
+        len(MAGIC_NUM[file_type][0])
+        for file_type in STREAM_DECOMPRESSORS
+    ))
+    stream = PrefixedStream(prefix, fileobj)
+    for file_type, get_decompressor in STREAM_DECOMPRESSORS.items():
+        if prefix.startswith(MAGIC_NUM[file_type][0]):
+            return DecompressingStream(stream, get_decompressor())
+    return stream
+
+
 def detect_file_type(path):
     'Examine the first few bytes of the given path to detect the file type'
     with open(path) as f:
@@ -707,33 +3630,160 @@ def detect_file_type(path):
     return None
 
 
-def extract_tar_archive(archive, target):
+def extract_tar_archive(archive, target, external_symlinks=False):
     logger.debug('extract_tar_archive: %s, %s', archive, target)
     archive_type = detect_file_type(archive)
 
-    compression_map = {
-        'GZIP': '--gzip',
-        'BZIP': '--bzip2',
-        'TAR': '',
-    }
-
-    compression_opt = compression_map.get(archive_type)
+    supported_types = set(['GZIP', 'BZIP', 'TAR'])
+    supported_types.update(STREAM_DECOMPRESSORS)
 
-    if compression_opt is None:
+    if archive_type not in supported_types:
         raise RuntimeError(
             'Failed to extract archive, unknown or unsupported file type',
         )
 
+    with open(archive, 'rb') as f:
+        extract_tar_stream(f, target, external_symlinks=external_symlinks)
+
+
+def retry_with_backoff(func, max_retries, description, base_delay=1, max_delay=60):
+    '''
+    Call func until it succeeds, retrying up to max_retries times.
+    Retries are delayed with an exponential backoff with full jitter.
+    '''
+    attempts = 0
+    while True:
+        try:
+            return func()
+        except Exception:
+            attempts = attempts + 1
+            if attempts > max_retries:
+                logger.error('Attempted to %s, but failed', description)
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempts))
+            logger.warning(
+                'There was an error trying to %s, retrying in %.1f seconds',
+                description,
+                delay,
+            )
+            time.sleep(delay)
+
+
+def download_ranges(size, local_path, fetch_range, part_size, workers, pool=None):
+    '''
+    Download size bytes into local_path as concurrent byte ranges.
+    fetch_range(start, end, f) writes the inclusive range start-end into the
+    file object f, which is positioned at start. The ranges are fetched in
+    the threads of pool when given.
+    '''
+    logger.debug('download_ranges: %s, %s', local_path, size)
+    with open(local_path, 'wb') as f:
+        f.truncate(size)
+    ranges = [
+        (start, min(start + part_size, size) - 1)
+        for start in xrange(0, size, part_size)
+    ]
+
+    def fetch(byte_range):
+        start, end = byte_range
+        with open(local_path, 'r+b') as f:
+            f.seek(start)
+            fetch_range(start, end, f)
+            if f.tell() != end + 1:
+                raise RuntimeError(
+                    'Incomplete download of bytes {}-{} of {}'.format(
+                        start,
+                        end,
+                        local_path,
+                    )
+                )
+
+    map_parallel(fetch, ranges, workers, pool=pool)
+
+
+def file_digest(path, digest_type):
+    h = hashlib.new(digest_type)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def verify_checksum(path, digest_type, expected):
+    actual = file_digest(path, digest_type)
+    if actual != expected:
+        raise RuntimeError(
+            'Checksum mismatch for {path}: expected {digest_type} {expected}, '
+            'got {actual}'.format(
+                path=path,
+                digest_type=digest_type,
+                expected=expected,
+                actual=actual,
+            )
+        )
+    logger.debug('Verified %s checksum of %s', digest_type, path)
+
+
+def extract_tar_stream(fileobj, target, external_symlinks=False):
+    '''
+    Extract a tar archive, optionally compressed with gzip, bzip2, zstd or
+    lz4, from a file object that is read sequentially, such as a network stream.
+    Members are never written outside of target, also not through links in
+    the archive. Symlinks that point outside of target are refused unless
+    external_symlinks, as a virtualenv links to the standard library.
+    '''
+    logger.debug('extract_tar_stream: %s', target)
     if not os.path.exists(target):
         os.mkdir(target)
-    command = [
-        'tar',
-        '--extract',
-        compression_opt,
-        '--file', archive,
-        '--directory', target,
-    ]
-    call_subprocess(command)
+    try:
+        archive = tarfile.open(
+            fileobj=open_decompressed_stream(fileobj),
+            mode='r|*',
+        )
+    except tarfile.ReadError:
+        raise RuntimeError(
+            'Failed to extract archive, unknown or unsupported file type',
+        )
+    with archive:
+        for member in archive:
+            path = os.path.normpath(member.name)
+            dest = os.path.join(target, path)
+            if member.issym() or member.islnk():
+                # The link itself replaces whatever is at dest
+                inside = is_within(os.path.dirname(dest), target)
+            else:
+                # Also refuses to write through a symlink extracted before
+                inside = is_within(dest, target)
+            if os.path.isabs(path) or path.startswith(os.pardir) or not inside:
+                raise RuntimeError(
+                    'Refusing to extract {} outside of {}'.format(
+                        member.name,
+                        target,
+                    )
+                )
+            if member.islnk():
+                # Hard links are relative to the root of the archive
+                link_target = os.path.join(target, member.linkname)
+            elif member.issym() and not external_symlinks:
+                link_target = os.path.join(os.path.dirname(dest), member.linkname)
+            else:
+                link_target = None
+            if link_target and not is_within(link_target, target):
+                raise RuntimeError(
+                    'Refusing to extract {} linking to {} outside of {}'.format(
+                        member.name,
+                        member.linkname,
+                        target,
+                    )
+                )
+            archive.extract(member, target)
+
+
+def is_within(path, directory):
+    'Return whether path, with its symlinks resolved, is inside directory'
+    path = os.path.realpath(path)
+    directory = os.path.realpath(directory)
+    return path == directory or path.startswith(directory + os.sep)
 
 
 def parse_requirements(path, ignore_comments=True):
@@ -766,12 +3816,208 @@ def parse_requirements(path, ignore_comments=True):
             yield line
 
 
+def replace_symlink(src, dst, remove=None):
+    '''
+    Atomically replace dst with a relative symlink to src. A directory at
+    dst is removed first, with remove when given.
+    '''
+    temp = '{}.{}.link'.format(dst, os.getpid())
+    if os.path.lexists(temp):
+        os.unlink(temp)
+    os.symlink(os.path.relpath(src, os.path.dirname(dst)), temp)
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        # A directory can not be replaced by a rename
+        (remove or rmtree)(dst)
+    os.rename(temp, dst)
+
+
+def start_reaper_session():
+    'Detach the reaper from the terminal, and lower its CPU priority'
+    os.setsid()
+    os.nice(19)
+
+
 def move_or_rename(src, dst):
     if src == dst:
         return
     return shutil.move(src, dst)
 
 
+def link_or_copy(src, dst):
+    'Hard link src to dst, falling back to a copy across file systems'
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def link_identical_files(src, dst):
+    '''
+    Replace the files in dst that are identical to the file at the same
+    path in src with a hard link to it, and return the number of bytes that
+    are no longer stored twice. A module is only linked together with its
+    bytecode, which records the modification time of the module.
+    '''
+    logger.debug('link_identical_files: %s, %s', src, dst)
+    saved = 0
+    for root, dirs, files in os.walk(dst):
+        src_root = os.path.normpath(os.path.join(src, os.path.relpath(root, dst)))
+        for name in files:
+            dst_path = os.path.join(root, name)
+            if is_bytecode(dst_path):
+                continue
+            paths = [dst_path]
+            if name.endswith('.py'):
+                paths.extend(get_bytecode_paths(dst_path))
+            pairs = [
+                (os.path.join(src_root, os.path.relpath(path, root)), path)
+                for path in paths
+            ]
+            if not is_identical(*pairs[0]) or not all(
+                can_link(src_path, path)
+                for src_path, path in pairs[1:]
+            ):
+                continue
+            for src_path, path in pairs:
+                if os.path.samefile(src_path, path):
+                    # A rename onto another link to the same file does nothing
+                    continue
+                saved += os.path.getsize(path)
+                temp = '{}.{}.link'.format(path, os.getpid())
+                os.link(src_path, temp)
+                os.rename(temp, path)
+    return saved
+
+
+def is_bytecode(path):
+    return path.endswith(('.pyc', '.pyo')) or '__pycache__' in path.split(os.sep)
+
+
+def get_bytecode_paths(module):
+    'Return the existing python 2 and 3 bytecode files of module'
+    directory, name = os.path.split(module)
+    stem = os.path.splitext(name)[0]
+    paths = [
+        path
+        for path in [module + 'c', module + 'o']
+        if os.path.isfile(path)
+    ]
+    paths.extend(glob.glob(os.path.join(
+        directory,
+        '__pycache__',
+        '{}.*.pyc'.format(stem),
+    )))
+    return paths
+
+
+def can_link(src, dst):
+    'Whether the file dst can be replaced with a hard link to src'
+    if os.path.islink(src) or os.path.islink(dst) or not os.path.isfile(src):
+        return False
+    src_stat = os.stat(src)
+    dst_stat = os.stat(dst)
+    return all([
+        src_stat.st_dev == dst_stat.st_dev,
+        src_stat.st_mode == dst_stat.st_mode,
+        src_stat.st_uid == dst_stat.st_uid,
+    ])
+
+
+def is_identical(src, dst):
+    'Whether dst can be linked to src, and is not already, and they are equal'
+    if not can_link(src, dst) or os.path.samefile(src, dst):
+        return False
+    if os.path.getsize(src) != os.path.getsize(dst):
+        return False
+    return filecmp.cmp(src, dst, shallow=False)
+
+
+def get_directory_size(directory):
+    return sum(
+        os.path.getsize(os.path.join(dirpath, name))
+        for dirpath, dirnames, filenames in os.walk(directory)
+        for name in filenames
+    )
+
+
+def link_tree(src, dst, copy=None):
+    '''
+    Recreate the directory tree src at dst, hard linking the files. Files
+    under either tree must be replaced, never modified in place, except the
+    ones that copy(path relative to src) is true for, which are copied.
+    '''
+    logger.debug('link_tree: %s, %s', src, dst)
+    rmtree(dst)
+    for root, dirs, files in os.walk(src):
+        dst_root = os.path.normpath(os.path.join(dst, os.path.relpath(root, src)))
+        os.mkdir(dst_root)
+        shutil.copystat(root, dst_root)
+        for name in dirs + files:
+            src_path = os.path.join(root, name)
+            dst_path = os.path.join(dst_root, name)
+            if os.path.islink(src_path):
+                os.symlink(os.readlink(src_path), dst_path)
+            elif name in files and copy and copy(os.path.relpath(src_path, src)):
+                shutil.copy2(src_path, dst_path)
+            elif name in files:
+                link_or_copy(src_path, dst_path)
+        # os.walk does not descend into symlinked directories
+        dirs[:] = [
+            name for name in dirs
+            if not os.path.islink(os.path.join(root, name))
+        ]
+
+
+def clone_virtualenv(src, dst):
+    '''
+    Copy the virtualenv src to dst, to restore it from if updating src in
+    place fails. The tree is cloned where the file system supports copy on
+    write. Otherwise the files are hard linked, except the ones that pip,
+    setuptools or python may rewrite in place.
+    '''
+    logger.debug('clone_virtualenv: %s, %s', src, dst)
+    rmtree(dst)
+    try:
+        process = subprocess.Popen(
+            ['cp', '-a', '--reflink=always', src, dst],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        output = process.communicate()[1]
+        if not process.returncode:
+            return
+        logger.debug('Unable to clone %s: %s', src, output.strip())
+    except OSError as e:
+        logger.debug('Unable to clone %s: %s', src, e)
+    rmtree(dst)
+    link_tree(src, dst, copy=is_rewritten_in_place)
+
+
+# Files that may be written to in place instead of replaced, such as .pth
+# files that setuptools appends to and bytecode that py_compile rewrites
+REWRITTEN_IN_PLACE_SUFFIXES = (
+    '.pyc',
+    '.pyo',
+    '.pth',
+    '.egg-link',
+    '.json',
+    '.txt',
+    '.cfg',
+)
+
+
+def is_rewritten_in_place(path):
+    'Whether the file at path, relative to a virtualenv, may be modified in place'
+    parts = path.split(os.sep)
+    return any([
+        path.endswith(REWRITTEN_IN_PLACE_SUFFIXES),
+        # Scripts and activate scripts
+        parts[0] == 'bin',
+        # Package metadata, such as RECORD and INSTALLER
+        any(part.endswith(('.dist-info', '.egg-info')) for part in parts[:-1]),
+    ])
+
+
 def rmtree(path):
     if not os.path.exists(path):
         return
@@ -801,13 +4047,28 @@ def make_temp_file(**kwargs):
 
 
 def initialize_logging(args):
+    level = logging.WARNING
+    level -= args.verbose_count * 10
+    level = max(level, logging.DEBUG)
+    if not args.log_file:
+        if args.quiet:
+            logger.disabled = True
+        else:
+            logger.setLevel(level)
+        return
+
+    # Everything is written to the log file, while the console only shows
+    # what the verbosity asks for
     if args.quiet:
-        logger.disabled = True
-    else:
-        level = logging.WARNING
-        level -= args.verbose_count * 10
-        level = max(level, logging.DEBUG)
-        logger.setLevel(level)
+        level = logging.CRITICAL + 1
+    for handler in logging.getLogger().handlers:
+        handler.setLevel(level)
+    handler = logging.FileHandler(args.log_file)
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s [%(levelname)s] %(message)s',
+    ))
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
 
 
 def update_python_warnings():
@@ -844,12 +4105,27 @@ def main():
             key = terrarium.make_remote_key()
             sys.stdout.write('{}\n'.format(key))
         elif args.command == 'install':
-            terrarium.install()
+            try:
+                terrarium.install()
+            finally:
+                terrarium.start_reaper()
+                terrarium.report_metrics(args.command)
         elif args.command == 'revert':
-            terrarium.restore_previously_backed_up_environment()
+            try:
+                if args.generation is not None:
+                    terrarium.switch_to_generation(args.generation)
+                else:
+                    terrarium.restore_previously_backed_up_environment()
+            finally:
+                terrarium.start_reaper()
+        elif args.command == 'gc':
+            terrarium.collect_garbage()
+            terrarium.share_generations()
     except RuntimeError as e:
         logger.error(e.message)
         sys.exit(1)
+    finally:
+        terrarium.remove_resolve_dir()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,18 @@
+from setuptools import setup
+
+setup_options = dict(
+    name='script_requirement',
+    version='0.1.0dev',
+    description='A test requirement fixture with a console script',
+    license='BSD',
+    url='',
+    packages=['script_requirement'],
+    long_description='',
+    entry_points={
+        'console_scripts': ['script-requirement = script_requirement:main'],
+    },
+    classifiers=[],
+    zip_safe=False,
+)
+
+setup(**setup_options)
@@ -1,29 +1,57 @@
+import BaseHTTPServer
+import SimpleHTTPServer
+import glob
+import hashlib
+import io
+import json
 import os
+import re
 import shlex
+import shutil
 import subprocess
 import sys
+import tarfile
 import tempfile
+import threading
+import time
 import unittest
+import urllib
+import urlparse
+import zipfile
 
+try:
+    import boto
+except ImportError:
+    boto = None
 
-def run_command(command):
+
+def run_command(command, timeout=None, env=None):
     params = {
         'stdout': subprocess.PIPE,
         'stderr': subprocess.PIPE,
     }
+    if env:
+        # Only for this command, on top of the environment of the tests
+        params['env'] = dict(os.environ, **env)
     result = subprocess.Popen(
         shlex.split(command),
         **params
     )
+    if timeout:
+        # Fail instead of waiting forever on a command that hangs
+        timer = threading.Timer(timeout, result.kill)
+        timer.start()
     stdout, stderr = result.communicate()
+    if timeout:
+        timer.cancel()
     sys.stdout.write(stdout)
     sys.stdout.write(stderr)
     return result.returncode, stdout.strip(), stderr.strip()
 
 
-def terrarium(options):
+def terrarium(options, timeout=None, env=None):
     command = 'terrarium {}'.format(options)
-    return run_command(command)
+    return run_command(command, timeout=timeout, env=env)
 
 
 def pip(env, options):
@@ -187,6 +215,134 @@ class CommandLineInterfaceTestCase(unittest.TestCase):
         # The original target + contents is not backed up
         assert not os.path.exists(self.target + '.bak')
 
+    def test_install_keeps_generations(self):
+        empty_file_name = _create_empty_requirements_file()
+        test_requirement = _get_fixture_path('test_requirement')
+        file_name = _create_requirements_file([test_requirement])
+        generations = self.target + '.generations'
+
+        options = '--target={} --generations --keep-generations=3'.format(self.target)
+        for requirements in [empty_file_name, file_name, empty_file_name, empty_file_name]:
+            rc, stdout, stderr = terrarium('{} install {}'.format(options, requirements))
+            self.assertEqual(rc, 0)
+        self.assertEqual(sorted(os.listdir(generations)), ['2', '3', '4'])
+
+        # Files that did not change are shared between generations by gc,
+        # which each install also starts in the background
+        rc, stdout, stderr = terrarium('--target={} gc'.format(self.target))
+        self.assertEqual(rc, 0)
+        activate_this = os.path.join('bin', 'activate_this.py')
+        self.assertEqual(
+            os.stat(os.path.join(generations, '3', activate_this)).st_ino,
+            os.stat(os.path.join(generations, '4', activate_this)).st_ino,
+        )
+
+        rc, stdout, stderr = terrarium('{} --generation=2 revert'.format(options))
+        self.assertEqual(rc, 0)
+        python = os.path.join(self.target, 'bin', 'python')
+        rc, stdout, stderr = run_command('{} -c "import test_requirement"'.format(python))
+        self.assertEqual(rc, 0)
+
+        rc, stdout, stderr = terrarium('{} --generation=1 revert'.format(options))
+        self.assertEqual(rc, 1)
+
+    def test_revert_to_generation_keeps_plain_target(self):
+        file_name = _create_empty_requirements_file()
+        generations = self.target + '.generations'
+
+        rc, stdout, stderr = terrarium('--target={} --generations install {}'.format(
+            self.target, file_name))
+        self.assertEqual(rc, 0)
+        # Installed again without --generations, so the target is a directory
+        rc, stdout, stderr = terrarium('--target={} install {}'.format(
+            self.target, file_name))
+        self.assertEqual(rc, 0)
+        assert not os.path.islink(self.target)
+        _create_file('bar', self.target, 'foo')
+
+        rc, stdout, stderr = terrarium('--target={} --generation=1 revert'.format(
+            self.target))
+        self.assertEqual(rc, 0)
+        self.assertEqual(os.readlink(self.target), os.path.join(
+            os.path.basename(generations), '1'))
+        # The environment that was at the target is kept as a generation
+        assert _file_exists(generations, '2', 'foo')
+
+    def test_install_with_background_delete(self):
+        file_name = _create_empty_requirements_file()
+        trash = self.target + '.trash'
+
+        # Create an existing target with some contents
+        os.makedirs(self.target)
+        _create_file('bar', self.target, 'foo')
+
+        options = '--target={} --no-backup --background-delete install {}'.format(
+            self.target, file_name)
+        rc, stdout, stderr = terrarium(options)
+        self.assertEqual(rc, 0)
+        assert _file_exists(self.target, 'bin', 'activate')
+        assert not _file_exists(self.target, 'foo')
+
+        # The old target is removed by a detached terrarium gc
+        for _ in range(100):
+            if not os.listdir(trash):
+                break
+            time.sleep(0.1)
+        self.assertEqual(os.listdir(trash), [])
+
+    def test_install_generations_moves_plain_backup_to_trash(self):
+        file_name = _create_empty_requirements_file()
+        backup_target = self.target + '.bak'
+
+        # Installed twice without --generations, so the backup is a directory
+        for _ in range(2):
+            rc, stdout, stderr = terrarium('--target={} install {}'.format(
+                self.target, file_name))
+            self.assertEqual(rc, 0)
+        assert not os.path.islink(backup_target)
+
+        options = '--target={} --generations --background-delete -VV install {}'.format(
+            self.target, file_name)
+        rc, stdout, stderr = terrarium(options)
+        self.assertEqual(rc, 0)
+        assert os.path.islink(backup_target)
+        assert 'Moving {} to {}.trash'.format(backup_target, self.target) in stdout
+
+    def test_install_generations_and_revert(self):
+        empty_file_name = _create_empty_requirements_file()
+        test_requirement = _get_fixture_path('test_requirement')
+        file_name = _create_requirements_file([test_requirement])
+        backup_target = self.target + '.bak'
+
+        # Create an existing target with some contents
+        os.makedirs(self.target)
+        _create_file('bar', self.target, 'original-target')
+
+        options = '--target={} --generations install'.format(self.target)
+        for requirements in [empty_file_name, file_name]:
+            rc, stdout, stderr = terrarium('{} {}'.format(options, requirements))
+            self.assertEqual(rc, 0)
+            assert os.path.islink(self.target)
+            assert os.path.islink(backup_target)
+        # Only the generations in use are kept
+        in_use = [os.path.realpath(path) for path in [self.target, backup_target]]
+        generations = os.path.realpath(self.target + '.generations')
+        self.assertEqual(
+            sorted(os.path.join(generations, name) for name in os.listdir(generations)),
+            sorted(in_use),
+        )
+        import_requirement = '{} -c "import test_requirement"'
+        python = os.path.join(self.target, 'bin', 'python')
+        rc, stdout, stderr = run_command(import_requirement.format(python))
+        self.assertEqual(rc, 0)
+
+        rc, stdout, stderr = terrarium('--target={} revert'.format(self.target))
+        self.assertEqual(rc, 0)
+        assert os.path.islink(self.target)
+        assert not os.path.exists(backup_target)
+        rc, stdout, stderr = run_command(import_requirement.format(python))
+        self.assertEqual(rc, 1)
+
     def test_require_download(self):
         file_name = _create_empty_requirements_file()
 
@@ -232,6 +388,7 @@ class CommandLineInterfaceTestCase(unittest.TestCase):
         self.assertEqual(stdout, '')
         assert stderr.endswith(expected_stderr)
 
+    @unittest.skipIf(boto is not None, 'boto is installed')
     def test_boto_required_to_use_s3_bucket(self):
         file_name = _create_empty_requirements_file()
 
@@ -248,11 +405,1043 @@ class CommandLineInterfaceTestCase(unittest.TestCase):
         self.assertEqual(stdout, '')
         assert stderr.endswith(expected_stderr)
 
+    def test_install_with_wheel_cache_dir(self):
+        file_name = _create_requirements_file(['six==1.16.0'])
+        wheel_cache_dir = _unique_name()
+
+        options = '--target={} --wheel-cache-dir={} install {}'.format(
+            self.target, wheel_cache_dir, file_name)
+
+        rc, stdout, stderr = terrarium(options)
+        self.assertEqual(rc, 0)
+        self.assertEqual(stderr, '')
+
+        cached_wheels = glob.glob(os.path.join(wheel_cache_dir, '*', '*', '*.whl'))
+        self.assertEqual(len(cached_wheels), 1)
+        assert os.path.basename(cached_wheels[0]).startswith('six-1.16.0-')
+
+        # The second build is satisfied by the wheel cache
+        options = '--target={} --no-backup --wheel-cache-dir={} -V install {}'.format(
+            self.target, wheel_cache_dir, file_name)
+
+        rc, stdout, stderr = terrarium(options)
+        self.assertEqual(rc, 0)
+        assert 'Found 1 of 1 requirements in the wheel cache' in stdout
+
+        python = os.path.join(self.target, 'bin', 'python')
+        rc, stdout, stderr = run_command('{} -c "import six"'.format(python))
+        self.assertEqual(rc, 0)
+
+    def test_incremental_install_only_installs_differences(self):
+        test_requirement = _get_fixture_path('test_requirement')
+        foo_requirement = _get_fixture_path('foo_requirement')
+        python = os.path.join(self.target, 'bin', 'python')
+
+        file_name = _create_requirements_file([test_requirement])
+        options = '--target={} install {}'.format(self.target, file_name)
+        rc, stdout, stderr = terrarium(options)
+        self.assertEqual(rc, 0)
+        _create_file('bar', self.target, 'foo')
+
+        file_name = _create_requirements_file([test_requirement, foo_requirement])
+        options = '--target={} --incremental -V install {}'.format(
+            self.target, file_name)
+        rc, stdout, stderr = terrarium(options)
+        self.assertEqual(rc, 0)
+        assert 'Removing 0 and installing 1 of 2 distributions' in stdout
+
+        # The environment was updated in place
+        assert _file_exists(self.target, 'foo')
+        rc, stdout, stderr = run_command(
+            '{} -c "import test_requirement, foo_requirement"'.format(python))
+        self.assertEqual(rc, 0)
+
+        # The previous environment is preserved as the backup
+        backup_python = os.path.join(self.target + '.bak', 'bin', 'python')
+        rc, stdout, stderr = run_command(
+            '{} -c "import foo_requirement"'.format(backup_python))
+        self.assertEqual(rc, 1)
+        # Files that may be rewritten in place are not shared with the backup
+        record = os.path.join(
+            'lib', 'python*', 'site-packages', 'test_requirement-*.dist-info', 'RECORD')
+        for path in [os.path.join('bin', 'activate'), record]:
+            path, = glob.glob(os.path.join(self.target, path))
+            backup_path = self.target + '.bak' + path[len(self.target):]
+            assert not os.path.samefile(path, backup_path)
+
+        file_name = _create_requirements_file([test_requirement])
+        options = '--target={} --incremental -V install {}'.format(
+            self.target, file_name)
+        rc, stdout, stderr = terrarium(options)
+        self.assertEqual(rc, 0)
+        assert 'Removing 1 and installing 0 of 1 distributions' in stdout
+
+    def test_install_streamed_from_storage_dir(self):
+        test_requirement = _get_fixture_path('test_requirement')
+        file_name = _create_requirements_file([test_requirement])
+        storage_dir = _unique_name()
+        os.makedirs(storage_dir)
+        python = os.path.join(self.target, 'bin', 'python')
+
+        options = '--target={} --storage-dir={} install {}'.format(
+            self.target, storage_dir, file_name)
+        rc, stdout, stderr = terrarium(options)
+        self.assertEqual(rc, 0)
+
+        options = '--target={} --storage-dir={} --require-download --stream'.format(
+            self.target, storage_dir)
+        options = '{} install {}'.format(options, file_name)
+        rc, stdout, stderr = terrarium(options)
+        self.assertEqual(rc, 0)
+        self.assertEqual(stderr, '')
+
+        rc, stdout, stderr = run_command(
+            '{} -c "import test_requirement"'.format(python))
+        self.assertEqual(rc, 0)
+
+    def test_require_download_looks_up_storage_dir(self):
+        test_requirement = _get_fixture_path('test_requirement')
+        file_name = _create_requirements_file([test_requirement])
+        storage_dir = _unique_name()
+        os.makedirs(storage_dir)
+
+        options = '--target={} --storage-dir={} install {}'.format(
+            self.target, storage_dir, file_name)
+        rc, stdout, stderr = terrarium(options)
+        self.assertEqual(rc, 0)
+
+        latency_file = _unique_name()
+        options = '--target={} --storage-dir={} --latency-file={} --require-download -VV'
+        options = options.format(self.target, storage_dir, latency_file)
+        rc, stdout, stderr = terrarium('{} install {}'.format(options, file_name))
+        self.assertEqual(rc, 0)
+        assert 'in storage_dir after' in stdout
+
+        # The latency is kept for the next run, next to those of other runs
+        with open(latency_file) as f:
+            latencies = json.load(f)
+        self.assertEqual(list(latencies), ['storage directory {}'.format(storage_dir)])
+        latencies['S3 bucket other'] = 1.5
+        with open(latency_file, 'w') as f:
+            json.dump(latencies, f)
+        rc, stdout, stderr = terrarium('{} install {}'.format(options, file_name))
+        self.assertEqual(rc, 0)
+        with open(latency_file) as f:
+            self.assertEqual(json.load(f)['S3 bucket other'], 1.5)
+
+    @unittest.skipIf(boto is None, 'boto is not installed')
+    def test_install_from_s3_endpoint(self):
+        test_requirement = _get_fixture_path('test_requirement')
+        file_name = _create_requirements_file([test_requirement])
+        python = os.path.join(self.target, 'bin', 'python')
+
+        server, s3_options = _serve_s3()
+        try:
+            options = '--target={} {} install {}'.format(
+                _unique_name(), s3_options, file_name)
+            rc, stdout, stderr = terrarium(options)
+            self.assertEqual(rc, 0)
+            key, = server.objects.keys()
+            assert 'x-amz-meta-sha256' in server.objects[key][2]
+
+            options = '--target={} {} --require-download -V install {}'.format(
+                self.target, s3_options, file_name)
+            rc, stdout, stderr = terrarium(options)
+            self.assertEqual(rc, 0)
+            assert 'from S3 bucket bucket' in stdout
+            # Downloaded in byte ranges
+            assert ('GET', key, {}, None) not in server.requests
+            assert any(
+                method == 'GET' and name == key and byte_range
+                for method, name, query, byte_range in server.requests
+            )
+        finally:
+            server.shutdown()
+        rc, stdout, stderr = run_command(
+            '{} -c "import test_requirement"'.format(python))
+        self.assertEqual(rc, 0)
+
+    @unittest.skipIf(boto is None, 'boto is not installed')
+    def test_s3_download_is_kept_in_storage_dir(self):
+        test_requirement = _get_fixture_path('test_requirement')
+        file_name = _create_requirements_file([test_requirement])
+        storage_dir = _unique_name()
+        os.makedirs(storage_dir)
+
+        server, s3_options = _serve_s3()
+        try:
+            rc, stdout, stderr = terrarium('--target={} {} install {}'.format(
+                _unique_name(), s3_options, file_name))
+            self.assertEqual(rc, 0)
+            key, = server.objects.keys()
+
+            rc, stdout, stderr = terrarium(
+                '--target={} --storage-dir={} {} --require-download install {}'.format(
+                    _unique_name(), storage_dir, s3_options, file_name))
+            self.assertEqual(rc, 0)
+        finally:
+            server.shutdown()
+        self.assertEqual(os.listdir(storage_dir), [key])
+
+        # The next run finds it locally
+        rc, stdout, stderr = terrarium(
+            '--target={} --storage-dir={} --require-download -V install {}'.format(
+                self.target, storage_dir, file_name))
+        self.assertEqual(rc, 0)
+        assert 'Using {} from storage directory'.format(key) in stdout
+        self.assertEqual(os.listdir(storage_dir), [key])
+
+    @unittest.skipIf(boto is None, 'boto is not installed')
+    def test_s3_multipart_upload_and_ranged_download(self):
+        part_size = 5 * 1024 * 1024
+        file_name = _create_requirements_file([
+            _create_large_requirement(part_size + 1024 * 1024),
+        ])
+        python = os.path.join(self.target, 'bin', 'python')
+
+        server, s3_options = _serve_s3()
+        options = '{} --transfer-part-size={} --transfer-workers=2'.format(
+            s3_options, part_size)
+        try:
+            rc, stdout, stderr = terrarium('--target={} {} install {}'.format(
+                _unique_name(), options, file_name))
+            self.assertEqual(rc, 0)
+            key, = server.objects.keys()
+            size = len(server.objects[key][0])
+            parts = sorted(
+                int(query['partNumber'])
+                for method, name, query, byte_range in server.requests
+                if method == 'PUT' and 'partNumber' in query
+            )
+            self.assertEqual(parts, [1, 2])
+            assert server.objects[key][1].endswith('-2')
+            self.assertEqual(server.uploads, {})
+
+            server.requests = []
+            rc, stdout, stderr = terrarium(
+                '--target={} {} --require-download install {}'.format(
+                    self.target, options, file_name))
+            self.assertEqual(rc, 0)
+            ranges = sorted(
+                byte_range
+                for method, name, query, byte_range in server.requests
+                if method == 'GET' and byte_range
+            )
+            self.assertEqual(ranges, [
+                'bytes=0-{}'.format(part_size - 1),
+                'bytes={}-{}'.format(part_size, size - 1),
+            ])
+        finally:
+            server.shutdown()
+        rc, stdout, stderr = run_command(
+            '{} -c "import large_requirement"'.format(python))
+        self.assertEqual(rc, 0)
+
+    @unittest.skipIf(boto is None, 'boto is not installed')
+    def test_s3_retries_failed_range(self):
+        test_requirement = _get_fixture_path('test_requirement')
+        file_name = _create_requirements_file([test_requirement])
+        python = os.path.join(self.target, 'bin', 'python')
+        # boto would otherwise retry the failed request itself
+        boto_config = _create_file('[Boto]\nnum_retries = 0\n', _unique_name())
+        env = {'BOTO_CONFIG': boto_config}
+
+        server, s3_options = _serve_s3()
+        try:
+            rc, stdout, stderr = terrarium('--target={} {} install {}'.format(
+                _unique_name(), s3_options, file_name), env=env)
+            self.assertEqual(rc, 0)
+
+            server.failing_range_requests = 1
+            rc, stdout, stderr = terrarium(
+                '--target={} {} --require-download install {}'.format(
+                    self.target, s3_options, file_name),
+                env=env,
+            )
+            self.assertEqual(rc, 0)
+            assert 'There was an error trying to download bytes 0-' in stdout
+            self.assertEqual(server.failing_range_requests, 0)
+
+            server.failing_range_requests = 2
+            rc, stdout, stderr = terrarium(
+                '--target={} {} --s3-max-retries=1 --require-download install {}'.format(
+                    _unique_name(), s3_options, file_name),
+                env=env,
+            )
+            self.assertEqual(rc, 1)
+        finally:
+            server.shutdown()
+        rc, stdout, stderr = run_command(
+            '{} -c "import test_requirement"'.format(python))
+        self.assertEqual(rc, 0)
+
+    def test_transfer_part_size_minimum(self):
+        file_name = _create_empty_requirements_file()
+        options = '--target={} --transfer-part-size=1024 install {}'.format(
+            self.target, file_name)
+
+        rc, stdout, stderr = terrarium(options)
+        self.assertEqual(rc, 2)
+        assert stderr.endswith('--transfer-part-size must be at least 5 MiB')
+
+    def test_install_from_http_mirror(self):
+        test_requirement = _get_fixture_path('test_requirement')
+        file_name = _create_requirements_file([test_requirement])
+        storage_dir = _unique_name()
+        os.makedirs(storage_dir)
+        python = os.path.join(self.target, 'bin', 'python')
+
+        options = '--target={} --storage-dir={} install {}'.format(
+            _unique_name(), storage_dir, file_name)
+        rc, stdout, stderr = terrarium(options)
+        self.assertEqual(rc, 0)
+
+        server, url = _serve_directory(storage_dir)
+        try:
+            options = '--target={} --http-mirror={} --require-download'.format(
+                self.target, url)
+            rc, stdout, stderr = terrarium('{} -V install {}'.format(options, file_name))
+        finally:
+            server.shutdown()
+        self.assertEqual(rc, 0)
+        assert 'from HTTP mirror' in stdout
+        rc, stdout, stderr = run_command(
+            '{} -c "import test_requirement"'.format(python))
+        self.assertEqual(rc, 0)
+
+    def test_install_relocatable(self):
+        test_requirement = _get_fixture_path('test_requirement')
+        file_name = _create_requirements_file([test_requirement])
+        storage_dir = _unique_name()
+        os.makedirs(storage_dir)
+        build_target = _unique_name()
+        python = os.path.join(self.target, 'bin', 'python')
+
+        options = '--target={} --storage-dir={} --relocatable install {}'.format(
+            build_target, storage_dir, file_name)
+        rc, stdout, stderr = terrarium(options)
+        self.assertEqual(rc, 0)
+        assert any(name.endswith('.venv') for name in os.listdir(storage_dir))
+
+        options = '--target={} --storage-dir={} --relocatable --require-download'.format(
+            self.target, storage_dir)
+        rc, stdout, stderr = terrarium('{} -V install {}'.format(options, file_name))
+        self.assertEqual(rc, 0)
+        assert 'Relocating virtualenv' in stdout
+        rc, stdout, stderr = run_command(
+            '{} -c "import test_requirement"'.format(python))
+        self.assertEqual(rc, 0)
+        with open(os.path.join(self.target, 'bin', 'activate')) as f:
+            activate = f.read()
+        assert self.target in activate
+        assert build_target not in activate
+
+        with open(os.path.join(self.target, '.terrarium.json')) as f:
+            info = json.load(f)
+        self.assertEqual(info['prefix'], self.target)
+
+        # The shipped bytecode is up to date, so it is used as is
+        compiled = os.path.join(
+            'lib', 'python*', 'site-packages', 'test_requirement', '__init__.pyc')
+        shipped, = glob.glob(os.path.join(build_target, compiled))
+        installed, = glob.glob(os.path.join(self.target, compiled))
+        with open(shipped, 'rb') as f, open(installed, 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+        # As extracted, archives keep whole seconds
+        self.assertEqual(int(os.stat(shipped).st_mtime), os.stat(installed).st_mtime)
+
+        # Installed at the path it was built at, the bytecode is also verified
+        options = '--target={} --storage-dir={} --relocatable --require-download'.format(
+            build_target, storage_dir)
+        rc, stdout, stderr = terrarium('{} -VV install {}'.format(options, file_name))
+        self.assertEqual(rc, 0)
+        assert 'Verifying the bytecode' in stdout
+
+    def test_http_mirror_lists_directory_index(self):
+        from terrarium import HTTPBackend, Terrarium, define_args
+
+        storage_dir = _unique_name()
+        os.makedirs(os.path.join(storage_dir, 'blobs', 'nested'))
+        for name in ['a b', 'abc', 'other']:
+            _create_file('', storage_dir, 'blobs', name)
+        _create_file('', storage_dir, 'top.manifest')
+
+        server, url = _serve_directory(storage_dir)
+        try:
+            args = define_args().parse_args(['--http-mirror', url, 'install'])
+            backend = HTTPBackend(Terrarium(args))
+            self.assertEqual(
+                backend.list('blobs/'), ['blobs/a b', 'blobs/abc', 'blobs/other'])
+            self.assertEqual(backend.list('blobs/a'), ['blobs/a b', 'blobs/abc'])
+            self.assertEqual(backend.list(''), ['top.manifest'])
+            self.assertEqual(backend.list('missing/'), [])
+        finally:
+            server.shutdown()
+
+    def test_install_refuses_archive_links_outside_target(self):
+        file_name = _create_requirements_file([_get_fixture_path('test_requirement')])
+        storage_dir = _unique_name()
+        outside = _unique_name()
+        os.makedirs(storage_dir)
+        os.makedirs(outside)
+
+        rc, stdout, stderr = terrarium('--target={} key {}'.format(self.target, file_name))
+        self.assertEqual(rc, 0)
+        key = stdout
+        # A symlink out of the target, and a file written through it
+        archive = tarfile.open(os.path.join(storage_dir, key), 'w')
+        link = tarfile.TarInfo('link')
+        link.type = tarfile.SYMTYPE
+        link.linkname = outside
+        archive.addfile(link)
+        evil = tarfile.TarInfo('link/evil')
+        evil.size = 5
+        archive.addfile(evil, io.BytesIO(b'evil\n'))
+        archive.close()
+        shutil.copy(
+            os.path.join(storage_dir, key),
+            os.path.join(storage_dir, '{}.venv'.format(key)),
+        )
+
+        for options in ['', '--stream', '--relocatable', '--relocatable --stream']:
+            rc, stdout, stderr = terrarium(
+                '--target={} --storage-dir={} --require-download {} install {}'.format(
+                    _unique_name(), storage_dir, options, file_name))
+            self.assertEqual(rc, 1)
+            assert 'Refusing to extract link' in stdout
+            self.assertEqual(os.listdir(outside), [])
+
+    def test_install_storage_dir_archive_compression(self):
+        test_requirement = _get_fixture_path('test_requirement')
+        file_name = _create_requirements_file([test_requirement])
+        python = os.path.join(self.target, 'bin', 'python')
+
+        magic_numbers = {
+            'gzip': '\x1f\x8b',
+            'zstd': '\x28\xb5\x2f\xfd',
+            'lz4': '\x04\x22\x4d\x18',
+        }
+        for compression, magic in magic_numbers.items():
+            storage_dir = _unique_name()
+            os.makedirs(storage_dir)
+
+            options = '--target={} --no-backup --storage-dir={} --compression={}'.format(
+                self.target, storage_dir, compression)
+            rc, stdout, stderr = terrarium(
+                '{} --compression-level=1 install {}'.format(options, file_name))
+            self.assertEqual(rc, 0)
+
+            archive, = os.listdir(storage_dir)
+            with open(os.path.join(storage_dir, archive), 'rb') as f:
+                self.assertEqual(f.read(len(magic)), magic)
+
+            for stream in ('', '--stream'):
+                options = '--target={} --no-backup --storage-dir={}'.format(
+                    self.target, storage_dir)
+                options = '{} --require-download'.format(options)
+                rc, stdout, stderr = terrarium(
+                    '{} {} install {}'.format(options, stream, file_name))
+                self.assertEqual(rc, 0)
+
+                rc, stdout, stderr = run_command(
+                    '{} -c "import test_requirement"'.format(python))
+                self.assertEqual(rc, 0)
+
+    def test_install_storage_dir_archive_no_compress(self):
+        file_name = _create_empty_requirements_file()
+        storage_dir = _unique_name()
+        os.makedirs(storage_dir)
+
+        options = '--target={} --storage-dir={} --no-compress install {}'.format(
+            self.target, storage_dir, file_name)
+        rc, stdout, stderr = terrarium(options)
+        self.assertEqual(rc, 0)
+
+        archive, = os.listdir(storage_dir)
+        with open(os.path.join(storage_dir, archive), 'rb') as f:
+            f.seek(257)
+            self.assertEqual(f.read(5), 'ustar')
+
+        options = '--target={} --storage-dir={} --require-download install {}'.format(
+            self.target, storage_dir, file_name)
+        rc, stdout, stderr = terrarium(options)
+        self.assertEqual(rc, 0)
+        assert _file_exists(self.target, 'requirements.txt')
+
+    def test_install_with_log_file(self):
+        test_requirement = _get_fixture_path('test_requirement')
+        file_name = _create_requirements_file([test_requirement])
+        log_file = _unique_name(suffix='.log')
+
+        options = '--target={} --log-file={} install {}'.format(
+            self.target, log_file, file_name)
+        rc, stdout, stderr = terrarium(options)
+        self.assertEqual(rc, 0)
+        # The console keeps its default verbosity
+        self.assertEqual(stdout, '')
+        with open(log_file) as f:
+            log = f.read()
+        assert 'Successfully built test-requirement' in log
+        assert 'pip exited with code 0 after' in log
+
+    def test_install_with_metrics(self):
+        test_requirement = _get_fixture_path('test_requirement')
+        file_name = _create_requirements_file([test_requirement])
+        storage_dir = _unique_name()
+        os.makedirs(storage_dir)
+        metrics_file = _unique_name(suffix='.jsonl')
+        textfile = _unique_name(suffix='.prom')
+
+        options = '--target={} --storage-dir={} --metrics-file={}'.format(
+            self.target, storage_dir, metrics_file)
+        options = '{} --prometheus-textfile={}'.format(options, textfile)
+        for _ in range(2):
+            rc, stdout, stderr = terrarium('{} install {}'.format(options, file_name))
+            self.assertEqual(rc, 0)
+
+        with open(metrics_file) as f:
+            built, downloaded = [json.loads(line) for line in f]
+        self.assertEqual(built['labels']['cache'], 'miss')
+        self.assertEqual(built['labels']['source'], 'build')
+        assert built['labels']['success']
+        for phase in ['build', 'extract', 'virtualenv', 'install', 'upload']:
+            assert phase in built['phases']
+        self.assertEqual(built['bytes']['uploaded'], built['bytes']['archive'])
+
+        self.assertEqual(downloaded['labels']['cache'], 'hit')
+        self.assertEqual(downloaded['labels']['backend'], 'storage_dir')
+        assert 'build' not in downloaded['phases']
+        assert 'backup' in downloaded['phases']
+        # Used where it is in the storage directory, so nothing is transferred
+        self.assertEqual(downloaded['bytes']['archive'], built['bytes']['archive'])
+        assert 'downloaded' not in downloaded['bytes']
+
+        with open(textfile) as f:
+            prometheus = f.read()
+        assert 'terrarium_install_success 1' in prometheus
+        assert 'terrarium_install_phase_seconds{phase="download"}' in prometheus
+
+    def test_install_with_parallel_jobs(self):
+        file_name = _create_requirements_file([
+            'six==1.16.0',
+            _get_fixture_path('test_requirement'),
+            _get_fixture_path('foo_requirement'),
+            'pyparsing==2.4.7',
+        ])
+        python = os.path.join(self.target, 'bin', 'python')
+
+        options = '--target={} --jobs=2 -V install {}'.format(self.target, file_name)
+
+        rc, stdout, stderr = terrarium(options)
+        self.assertEqual(rc, 0)
+        assert 'Building 2 wheels with 2 parallel jobs' in stdout
+
+        rc, stdout, stderr = run_command(
+            '{} -c "import six, pyparsing, foo_requirement"'.format(python))
+        self.assertEqual(rc, 0)
+
+    def test_fast_install(self):
+        file_name = _create_requirements_file([
+            _get_fixture_path('test_requirement'),
+            _get_fixture_path('foo_requirement'),
+            _get_fixture_path('script_requirement'),
+        ])
+
+        options = '--target={} --fast-install --jobs=2 install {}'.format(
+            self.target, file_name)
+        rc, stdout, stderr = terrarium(options)
+        self.assertEqual(rc, 0)
+        self.assertEqual(stderr, '')
+
+        # Console scripts are generated
+        script = os.path.join(self.target, 'bin', 'script-requirement')
+        rc, stdout, stderr = run_command(script)
+        self.assertEqual(rc, 0)
+        self.assertEqual(stdout, 'script_requirement')
+
+        # Modules are compiled
+        site_packages, = glob.glob(
+            os.path.join(self.target, 'lib', 'python*', 'site-packages'))
+        assert _file_exists(site_packages, 'foo_requirement', '__init__.pyc')
+
+        # The installed distributions are recorded, so pip can remove them
+        rc, stdout, stderr = pip(self.target, 'uninstall --yes script_requirement')
+        self.assertEqual(rc, 0)
+        assert not os.path.exists(script)
+        assert not _file_exists(site_packages, 'script_requirement')
+
+    def test_fast_install_rejects_paths_outside_virtualenv(self):
+        wheel_dir = _unique_name()
+        os.makedirs(wheel_dir)
+        wheel = os.path.join(wheel_dir, 'evil-0.1-py2.py3-none-any.whl')
+        with zipfile.ZipFile(wheel, 'w') as archive:
+            archive.writestr('evil-0.1.dist-info/METADATA', 'Name: evil\nVersion: 0.1\n')
+            archive.writestr('evil-0.1.dist-info/WHEEL', 'Root-Is-Purelib: true\n')
+            archive.writestr('evil-0.1.dist-info/RECORD', '')
+            archive.writestr('../../../evil', 'evil\n')
+        file_name = _create_requirements_file([wheel])
+
+        options = '--target={} --fast-install install {}'.format(self.target, file_name)
+        rc, stdout, stderr = terrarium(options)
+        self.assertEqual(rc, 1)
+        assert 'Refusing to install ../../../evil' in stdout
+        # Would have been written next to lib
+        assert not _file_exists(self.target, 'evil')
+
+    def test_storage_dir_wheels_requires_storage_dir(self):
+        file_name = _create_empty_requirements_file()
+        options = '--target={} --storage-dir-wheels install {}'.format(
+            self.target, file_name)
+
+        rc, stdout, stderr = terrarium(options)
+        self.assertEqual(rc, 2)
+        assert stderr.endswith('--storage-dir-wheels requires --storage-dir')
+        assert not os.path.exists(self.target)
+
+    def test_install_from_storage_dir_wheels(self):
+        test_requirement = _get_fixture_path('test_requirement')
+        file_name = _create_requirements_file([test_requirement])
+        storage_dir = _unique_name()
+        os.makedirs(storage_dir)
+        python = os.path.join(self.target, 'bin', 'python')
+
+        options = '--target={} --storage-dir={} --storage-dir-wheels'.format(
+            self.target, storage_dir)
+        rc, stdout, stderr = terrarium('{} install {}'.format(options, file_name))
+        self.assertEqual(rc, 0)
+
+        archive, wheels = sorted(os.listdir(storage_dir))
+        self.assertEqual(wheels, '{}.wheels'.format(archive))
+        assert _file_exists(storage_dir, wheels, 'requirements.txt')
+
+        # The extracted wheels are used instead of the archive
+        os.unlink(os.path.join(storage_dir, archive))
+        rc, stdout, stderr = terrarium('{} --require-download -V install {}'.format(
+            options, file_name))
+        self.assertEqual(rc, 0)
+        assert 'Linking wheels from' in stdout
+
+        rc, stdout, stderr = run_command(
+            '{} -c "import test_requirement"'.format(python))
+        self.assertEqual(rc, 0)
+
+    def test_hash_canonical_digest(self):
+        file_name = _create_requirements_file([
+            'Django>=1.11,<2.0',
+            'six==1.16.0',
+        ])
+        equivalent_file_name = _create_requirements_file([
+            '# Reordered, with comments, blank lines and different spelling',
+            'six == 1.16.0  # inline comment',
+            '',
+            'django <2.0, >=1.11',
+        ])
+
+        rc, digest, stderr = terrarium('hash {}'.format(file_name))
+        self.assertEqual(rc, 0)
+        rc, equivalent_digest, stderr = terrarium('hash {}'.format(equivalent_file_name))
+        self.assertEqual(rc, 0)
+        self.assertNotEqual(digest, equivalent_digest)
+
+        rc, digest, stderr = terrarium('--canonical-digest hash {}'.format(file_name))
+        self.assertEqual(rc, 0)
+        rc, equivalent_digest, stderr = terrarium(
+            '--canonical-digest hash {}'.format(equivalent_file_name))
+        self.assertEqual(rc, 0)
+        self.assertEqual(digest, equivalent_digest)
+
+        different_file_name = _create_requirements_file([
+            'Django>=1.11,<2.0',
+            'six==1.15.0',
+        ])
+        rc, different_digest, stderr = terrarium(
+            '--canonical-digest hash {}'.format(different_file_name))
+        self.assertEqual(rc, 0)
+        self.assertNotEqual(digest, different_digest)
+
+    def test_install_resolved_requirements(self):
+        test_requirement = _get_fixture_path('test_requirement')
+        file_name = _create_requirements_file(['six==1.16.0', test_requirement])
+        equivalent_file_name = _create_requirements_file([
+            'six>=1.16,<1.17',
+            test_requirement,
+        ])
+
+        rc, digest, stderr = terrarium('--resolve hash {}'.format(file_name))
+        self.assertEqual(rc, 0)
+        rc, equivalent_digest, stderr = terrarium(
+            '--resolve hash {}'.format(equivalent_file_name))
+        self.assertEqual(rc, 0)
+        self.assertEqual(digest, equivalent_digest)
+
+        options = '--target={} --resolve -VV install {}'.format(
+            self.target, equivalent_file_name)
+        rc, stdout, stderr = terrarium(options)
+        self.assertEqual(rc, 0)
+        # Built from the downloads that were resolved, without the index
+        self.assertEqual(stdout.count("call_subprocess: ['pip', 'download'"), 1)
+        self.assertEqual(stdout.count('Looking in indexes'), 1)
+        resolve_dir, = re.findall(r'Looking in links: .*, (\S*terrarium-resolve-\S*)', stdout)
+        # and removed once done
+        assert not os.path.exists(resolve_dir)
+
+        with open(os.path.join(self.target, 'requirements.txt')) as f:
+            self.assertEqual(f.read().splitlines(), ['six>=1.16,<1.17', test_requirement])
+        with open(os.path.join(self.target, 'requirements.lock')) as f:
+            locked = f.read().splitlines()
+        self.assertEqual(len(locked), 2)
+        assert locked[0].startswith('six==1.16.0 --hash=sha256:')
+        self.assertEqual(locked[1], test_requirement)
+
+    def test_install_dedup_storage_dir(self):
+        storage_dir = _unique_name()
+        blob_cache_dir = _unique_name()
+        os.makedirs(storage_dir)
+        python = os.path.join(self.target, 'bin', 'python')
+        options = '--target={} --storage-dir={} --blob-cache-dir={} --dedup'.format(
+            self.target, storage_dir, blob_cache_dir)
+
+        file_name = _create_requirements_file(['six==1.16.0'])
+        rc, stdout, stderr = terrarium('{} install {}'.format(options, file_name))
+        self.assertEqual(rc, 0)
+        self.assertEqual(len(os.listdir(os.path.join(storage_dir, 'blobs'))), 2)
+
+        # Only the new files are stored for the second environment
+        file_name = _create_requirements_file([
+            'six==1.16.0',
+            _get_fixture_path('test_requirement'),
+        ])
+        rc, stdout, stderr = terrarium('{} -V install {}'.format(options, file_name))
+        self.assertEqual(rc, 0)
+        assert 'Uploading 2 of 3 files to storage_dir' in stdout
+        self.assertEqual(len(os.listdir(os.path.join(storage_dir, 'blobs'))), 4)
+        self.assertEqual(len(glob.glob(os.path.join(storage_dir, '*.manifest'))), 2)
+
+        rc, stdout, stderr = terrarium('{} --require-download -V install {}'.format(
+            options, file_name))
+        self.assertEqual(rc, 0)
+        assert 'Downloading 3 of 3 files' in stdout
+
+        rc, stdout, stderr = terrarium('{} --require-download -V install {}'.format(
+            options, file_name))
+        self.assertEqual(rc, 0)
+        assert 'Downloading 0 of 3 files' in stdout
+
+        rc, stdout, stderr = run_command(
+            '{} -c "import six, test_requirement"'.format(python))
+        self.assertEqual(rc, 0)
+
+    def test_install_dedup_from_ranged_mirror(self):
+        storage_dir = _unique_name()
+        os.makedirs(storage_dir)
+        python = os.path.join(self.target, 'bin', 'python')
+        file_name = _create_requirements_file([
+            'six==1.16.0',
+            _get_fixture_path('test_requirement'),
+        ])
+
+        options = '--target={} --storage-dir={} --dedup install {}'.format(
+            _unique_name(), storage_dir, file_name)
+        rc, stdout, stderr = terrarium(options)
+        self.assertEqual(rc, 0)
+
+        # More files than transfer threads, each downloaded in byte ranges
+        server, url = _serve_directory(storage_dir, handler=_RangeRequestHandler)
+        temp_dir = _unique_name()
+        os.makedirs(temp_dir)
+        try:
+            options = '--target={} --http-mirror={} --dedup --transfer-workers=1'.format(
+                self.target, url)
+            rc, stdout, stderr = terrarium(
+                '{} --require-download -V install {}'.format(options, file_name),
+                timeout=120,
+                env={'TMPDIR': temp_dir},
+            )
+        finally:
+            server.shutdown()
+        self.assertEqual(rc, 0)
+        assert 'Downloading 3 of 3 files' in stdout
+        # Neither the manifest nor the blobs outlive the install
+        self.assertEqual(glob.glob(os.path.join(temp_dir, '*.manifest')), [])
+        self.assertEqual(glob.glob(os.path.join(temp_dir, 'terrarium-blobs-*')), [])
+        rc, stdout, stderr = run_command(
+            '{} -c "import six, test_requirement"'.format(python))
+        self.assertEqual(rc, 0)
+
+    def test_install_delta_from_storage_dir(self):
+        storage_dir = _unique_name()
+        os.makedirs(storage_dir)
+        python = os.path.join(self.target, 'bin', 'python')
+        old_requirements = _create_requirements_file(['six==1.16.0'])
+        new_requirements = _create_requirements_file([
+            _get_fixture_path('test_requirement'),
+        ])
+
+        # Building the new environment over the old one uploads a delta
+        options = '--target={} --storage-dir={} --delta'.format(
+            _unique_name(),
+            storage_dir,
+        )
+        rc, stdout, stderr = terrarium('{} install {}'.format(options, old_requirements))
+        self.assertEqual(rc, 0)
+        rc, stdout, stderr = terrarium('{} -V install {}'.format(options, new_requirements))
+        self.assertEqual(rc, 0)
+        assert 'Uploading delta from' in stdout
+        self.assertEqual(len(glob.glob(os.path.join(storage_dir, '*.delta-*'))), 1)
+
+        options = '--target={} --storage-dir={} --delta --require-download'.format(
+            self.target,
+            storage_dir,
+        )
+        rc, stdout, stderr = terrarium('{} install {}'.format(options, old_requirements))
+        self.assertEqual(rc, 0)
+        assert os.path.exists(os.path.join(self.target, '.terrarium.json'))
+
+        rc, stdout, stderr = terrarium('{} -V install {}'.format(options, new_requirements))
+        self.assertEqual(rc, 0)
+        assert 'Installing delta from' in stdout
+        assert 'Removing 1 and installing 1 of 1 distributions' in stdout
+        rc, stdout, stderr = run_command('{} -c "import test_requirement"'.format(python))
+        self.assertEqual(rc, 0)
+        rc, stdout, stderr = run_command('{} -c "import six"'.format(python))
+        self.assertNotEqual(rc, 0)
+
+        # Without a delta from the installed environment, the full one is used
+        rc, stdout, stderr = terrarium('{} -V install {}'.format(options, old_requirements))
+        self.assertEqual(rc, 0)
+        assert 'No delta from' in stdout
+        rc, stdout, stderr = run_command('{} -c "import six"'.format(python))
+        self.assertEqual(rc, 0)
+
+
+def _create_large_requirement(size):
+    'Create a requirement with size bytes of incompressible package data'
+    path = _unique_name()
+    os.makedirs(os.path.join(path, 'large_requirement'))
+    _create_file('', path, 'large_requirement', '__init__.py')
+    with open(os.path.join(path, 'large_requirement', 'data.bin'), 'wb') as f:
+        f.write(os.urandom(size))
+    _create_file('''from setuptools import setup
+
+setup(
+    name='large_requirement',
+    version='0.1.0',
+    packages=['large_requirement'],
+    package_data={'large_requirement': ['data.bin']},
+    zip_safe=False,
+)
+''', path, 'setup.py')
+    return path
+
+
+def _get_fixture_path(*path_spec):
+    return os.path.join(os.path.dirname(__file__), 'fixtures', *path_spec)
+
 
 def _file_exists(*path_spec):
     return os.path.exists(os.path.join(*path_spec))
 
 
+class _DirectoryRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    def translate_path(self, path):
+        return os.path.join(
+            self.server.directory,
+            path.split('?', 1)[0].lstrip('/'),
+        )
+
+    def log_message(self, *args):
+        pass
+
+
+class _RangeRequestHandler(_DirectoryRequestHandler):
+    'Also serves the byte range in the Range header of a request'
+
+    def end_headers(self):
+        self.send_header('Accept-Ranges', 'bytes')
+        _DirectoryRequestHandler.end_headers(self)
+
+    def do_GET(self):
+        match = re.match(r'^bytes=(\d+)-(\d+)$', self.headers.get('Range', ''))
+        if not match:
+            return _DirectoryRequestHandler.do_GET(self)
+        start, end = [int(group) for group in match.groups()]
+        with open(self.translate_path(self.path), 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start + 1)
+        self.send_response(206)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class _S3RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    A stand-in for the parts of the S3 API that terrarium uses, with path
+    style bucket URLs. Requests are not authenticated.
+    '''
+
+    def parse(self):
+        url = urlparse.urlparse(self.path)
+        bucket, _, key = url.path.lstrip('/').partition('/')
+        query = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        self.server.requests.append((
+            self.command,
+            urllib.unquote(key),
+            query,
+            self.headers.get('Range'),
+        ))
+        return urllib.unquote(key), query
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def get_metadata(self):
+        return dict(
+            (name, value) for name, value in self.headers.items()
+            if name.lower().startswith('x-amz-meta-')
+        )
+
+    def respond(self, status, body='', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def object_headers(self, key):
+        data, etag, metadata = self.server.objects[key]
+        headers = {'ETag': '"{}"'.format(etag), 'Accept-Ranges': 'bytes'}
+        headers.update(metadata)
+        return headers
+
+    def do_HEAD(self):
+        key, query = self.parse()
+        if key not in self.server.objects:
+            return self.respond(404)
+        headers = self.object_headers(key)
+        headers['Content-Length'] = str(len(self.server.objects[key][0]))
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def do_GET(self):
+        key, query = self.parse()
+        if not key:
+            contents = ''.join(
+                '<Contents><Key>{}</Key><Size>{}</Size></Contents>'.format(
+                    name, len(data))
+                for name, (data, etag, metadata) in sorted(self.server.objects.items())
+                if name.startswith(query.get('prefix', ''))
+            )
+            return self.respond(200, (
+                '<?xml version="1.0" encoding="UTF-8"?>'
+                '<ListBucketResult><IsTruncated>false</IsTruncated>{}'
+                '</ListBucketResult>'
+            ).format(contents))
+        if 'uploadId' in query:
+            parts = ''.join(
+                '<Part><PartNumber>{}</PartNumber><ETag>"{}"</ETag>'
+                '<Size>{}</Size></Part>'.format(
+                    number, hashlib.md5(data).hexdigest(), len(data))
+                for number, data in sorted(
+                    self.server.uploads[query['uploadId']]['parts'].items())
+            )
+            return self.respond(200, (
+                '<?xml version="1.0" encoding="UTF-8"?>'
+                '<ListPartsResult><IsTruncated>false</IsTruncated>{}'
+                '</ListPartsResult>'
+            ).format(parts))
+        if key not in self.server.objects:
+            return self.respond(404)
+        data = self.server.objects[key][0]
+        match = re.match(r'^bytes=(\d+)-(\d+)$', self.headers.get('Range', ''))
+        if not match:
+            return self.respond(200, data, self.object_headers(key))
+        if self.server.failing_range_requests:
+            self.server.failing_range_requests -= 1
+            return self.respond(500)
+        start, end = [int(group) for group in match.groups()]
+        self.respond(206, data[start:end + 1])
+
+    def do_PUT(self):
+        key, query = self.parse()
+        data = self.read_body()
+        etag = hashlib.md5(data).hexdigest()
+        if 'uploadId' in query:
+            upload = self.server.uploads[query['uploadId']]
+            upload['parts'][int(query['partNumber'])] = data
+        else:
+            self.server.objects[key] = (data, etag, self.get_metadata())
+        self.respond(200, headers={'ETag': '"{}"'.format(etag)})
+
+    def do_POST(self):
+        key, query = self.parse()
+        self.read_body()
+        if 'uploads' in query:
+            upload_id = str(len(self.server.uploads) + 1)
+            self.server.uploads[upload_id] = {
+                'parts': {},
+                'metadata': self.get_metadata(),
+            }
+            return self.respond(200, (
+                '<?xml version="1.0" encoding="UTF-8"?>'
+                '<InitiateMultipartUploadResult><Bucket>bucket</Bucket>'
+                '<Key>{}</Key><UploadId>{}</UploadId>'
+                '</InitiateMultipartUploadResult>'
+            ).format(key, upload_id))
+        upload = self.server.uploads.pop(query['uploadId'])
+        parts = [data for number, data in sorted(upload['parts'].items())]
+        etag = '{}-{}'.format(
+            hashlib.md5(''.join(hashlib.md5(data).digest() for data in parts)).hexdigest(),
+            len(parts),
+        )
+        self.server.objects[key] = (''.join(parts), etag, upload['metadata'])
+        self.respond(200, (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<CompleteMultipartUploadResult><Bucket>bucket</Bucket>'
+            '<Key>{}</Key><ETag>"{}"</ETag></CompleteMultipartUploadResult>'
+        ).format(key, etag))
+
+    def do_DELETE(self):
+        key, query = self.parse()
+        self.server.uploads.pop(query.get('uploadId'), None)
+        self.respond(204)
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve_s3():
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), _S3RequestHandler)
+    # key: (data, etag, metadata headers)
+    server.objects = {}
+    server.uploads = {}
+    server.requests = []
+    server.failing_range_requests = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    options = ' '.join([
+        '--s3-bucket=bucket',
+        '--s3-endpoint=http://127.0.0.1:{}'.format(server.server_address[1]),
+        '--s3-access-key=access-key',
+        '--s3-secret-key=secret-key',
+    ])
+    return server, options
+
+
+def _serve_directory(directory, handler=_DirectoryRequestHandler):
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), handler)
+    server.directory = directory
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
 def _unique_name(**kwargs):
     prefix = kwargs.pop('prefix', 'terrarium-test-')
     return tempfile.mktemp(prefix=prefix, **kwargs)